@@ -0,0 +1,239 @@
+import asyncio
+import time
+from collections import deque
+from config import ServerClusterConfig
+from message import *
+from error import FollowNewMasterError
+from quorum import QuorumTracker
+from server import Server, PROFILE_FLUSH_WAIT
+
+
+class MasterProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, address):
+        raw = self.server.channel.reassemble(data, address)
+        if raw is None:
+            # more fragments to come
+            return
+        message = self.server.decode_from(raw, address)
+        if message is None:
+            # another group
+            return
+        self.server.dispatch_on_loop(message, address)
+
+    def error_received(self, exc):
+        # icmp errors from dead replicas, the proposal timeout takes care of them
+        pass
+
+
+class AsyncServer(Server):
+    """
+    Runs the master on a single asyncio event loop instead of forking
+    processes for every proposal. Nothing is forked, so the state is owned
+    by this process and replicas learn in the dispatcher as well.
+    """
+    shared_state = False
+
+    def __init__(self, uid, config: ServerClusterConfig, skip_slots=None, group=0):
+        super(AsyncServer, self).__init__(uid, config, skip_slots=skip_slots, group=group)
+        self.loop = None
+        self.transport = None
+        # {slot: Future} resolved once f replicas accepted the proposal
+        self.slot_futures = {}
+        self.quorum = QuorumTracker(self.get_f(), config.max_in_flight)
+        # (operation, client_address) waiting for a free slot in the window
+        self.waiting_operations = deque()
+        # {slot: set of replica uid} counted by replicas in the broadcast commit mode
+        self.accepted_uids = {}
+        # {slot: Proposal} accepted by this replica and waiting for f - 1 other accepts
+        self.learning_proposals = {}
+        # closes the batch window of the RequestBatcher
+        self.batch_timer = None
+        # resolved with the FollowNewMasterError of a later view, which ends the loop
+        self.serving = None
+        # slots decided since the last Commit was sent
+        self.committed_slots = []
+
+    def _send(self, address, byte: bytes):
+        if self.transport is None:
+            super(AsyncServer, self)._send(address, byte)
+        else:
+            # the transport only exists on the master, which never loses messages
+            for datagram in self.channel.fragment(byte):
+                self.transport.sendto(datagram, address)
+
+    async def propose_worker(self, proposal: Proposal):
+        started = time.perf_counter()
+        self.send_all(proposal)
+        try:
+            await asyncio.wait_for(self.slot_futures[proposal.slot], self.get_default_timeout())
+            decided_at = time.perf_counter()
+        except asyncio.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.count('quorum_timeout')
+            self.reply_client(proposal, False)
+            return
+        finally:
+            self.slot_futures.pop(proposal.slot, None)
+            self.quorum.close(proposal.slot)
+            self.propose_waiting()
+        if self.metrics is not None:
+            self.metrics.time('quorum', decided_at - started)
+        delivered_proposals = self.state.learn_proposal(proposal)
+        if self.leader_commit:
+            self.commit_later(proposal.slot)
+        for delivered in delivered_proposals:
+            self.reply_client(delivered, True)
+        self.send_digest_check()
+
+    def stats_gauges(self):
+        gauges = super(AsyncServer, self).stats_gauges()
+        gauges['in_flight'] = len(self.quorum)
+        gauges['waiting_operations'] = len(self.waiting_operations)
+        return gauges
+
+    def commit_later(self, slot):
+        # slots decided within the same loop iteration share one Commit message
+        if not self.committed_slots:
+            self.loop.call_soon(self.flush_commits)
+        self.committed_slots.append(slot)
+
+    def flush_commits(self):
+        self.send_commit(self.committed_slots)
+        self.committed_slots = []
+
+    def replica_learner(self, slot):
+        proposal = self.learning_proposals.get(slot)
+        # with the proposal and self, it only need f-1 other accept messages
+        if proposal is not None and len(self.accepted_uids.get(slot, ())) >= self.get_f() - 1:
+            self.learning_proposals.pop(slot)
+            self.accepted_uids.pop(slot, None)
+            self.state.learn_proposal(proposal)
+
+    def start_learner(self, proposal: Proposal):
+        self.learning_proposals[proposal.slot] = proposal
+        self.replica_learner(proposal.slot)
+
+    def handle_accept(self, accept: Accept):
+        if self.state.is_master:
+            super(AsyncServer, self).handle_accept(accept)
+            return
+        slot = accept.proposal.slot
+        if not self.state.is_learned(slot):
+            self.accepted_uids.setdefault(slot, set()).add(accept.uid)
+            self.replica_learner(slot)
+
+    def drop_message_rings(self):
+        # the accepts counted in the previous view, a proposal of the new view starts from none
+        self.accepted_uids = {}
+        self.learning_proposals = {}
+
+    def count_accept(self, slot, uid):
+        if self.quorum.ack(slot, uid):
+            self.slot_futures[slot].set_result(True)
+
+    def handle_client_request(self, message: ClientRequest, client_address):
+        super(AsyncServer, self).handle_client_request(message, client_address)
+        if self.batch_timer is None and self.batcher is not None and self.batcher.time_left() is not None:
+            self.batch_timer = self.loop.call_later(self.batcher.time_left(), self.flush_batch)
+
+    def flush_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        super(AsyncServer, self).flush_batch()
+
+    def propose(self, operation, client_address):
+        if self.waiting_operations or not self.quorum.has_room(self.state.get_next_available_slot()):
+            self.waiting_operations.append((operation, client_address))
+        else:
+            self.start_proposal(operation, client_address)
+
+    def start_proposal(self, operation, client_address):
+        self.open_proposal(self.assign_slot(operation, client_address))
+
+    def repropose(self, slot):
+        proposal = self.state.get_accepted_proposal(slot)
+        if proposal is not None and slot not in self.slot_futures and self.quorum.has_room(slot):
+            self.open_proposal(proposal)
+
+    def open_proposal(self, proposal: Proposal):
+        self.quorum.open(proposal.slot)
+        self.slot_futures[proposal.slot] = self.loop.create_future()
+        self.loop.create_task(self.propose_worker(proposal))
+
+    def propose_waiting(self):
+        while self.waiting_operations and self.quorum.has_room(self.state.get_next_available_slot()):
+            operation, client_address = self.waiting_operations.popleft()
+            self.start_proposal(operation, client_address)
+
+    def renew_lease_periodically(self):
+        self.loop.call_later(self.renew_lease(), self.renew_lease_periodically)
+
+    def heartbeat_periodically(self):
+        self.loop.call_later(self.send_heartbeat(), self.heartbeat_periodically)
+
+    def merge_profile_later(self):
+        if self.transport is None:
+            super(AsyncServer, self).merge_profile_later()
+        else:
+            # a signal handler does not wake the loop up by itself
+            self.loop.call_soon_threadsafe(self.loop.call_later, PROFILE_FLUSH_WAIT, self.merge_profile)
+
+    def sync_log_periodically(self):
+        # the records appended before an idle period are fsynced within the interval as well
+        self.state.sync_log()
+        sync_left = self.state.sync_log_left()
+        self.loop.call_later(self.config.fsync_interval if sync_left is None else sync_left,
+                             self.sync_log_periodically)
+
+    async def master_dispatcher(self):
+        self.loop = asyncio.get_running_loop()
+        # the transport closes its socket when the master steps down, the replica keeps receiving on this one
+        await self.loop.create_datagram_endpoint(lambda: MasterProtocol(self), sock=self.socket.dup())
+        for _, decoded, _ in self.receivers:
+            self.loop.add_reader(decoded.fileno(), self.receive_decoded, decoded)
+        if self.config.read_lease:
+            self.renew_lease_periodically()
+        if self.config.heartbeat_interval > 0:
+            self.heartbeat_periodically()
+        if self.config.wal_dir is not None and self.config.fsync_policy == 'interval':
+            self.sync_log_periodically()
+        # serve until a later view is elected
+        self.serving = self.loop.create_future()
+        try:
+            await self.serving
+        finally:
+            # nothing more is proposed while the proposals in flight are cancelled
+            self.waiting_operations.clear()
+            self.transport.close()
+            self.transport = None
+
+    def dispatch_on_loop(self, message: BaseMessage, address):
+        try:
+            self.timed_dispatch(self.dispatch_master_message, message, address)
+        except FollowNewMasterError as e:
+            # raised out of asyncio.run to the election state machine
+            if not self.serving.done():
+                self.serving.set_exception(e)
+
+    def receive_decoded(self, decoded):
+        # the messages of a receive worker, the kernel spreads the senders over its socket and the one of the loop
+        while decoded.poll():
+            message, address = self.receive_decoded_message(decoded)
+            self.dispatch_on_loop(message, address)
+
+    def master_main(self):
+        try:
+            asyncio.run(self.master_dispatcher())
+        finally:
+            # a later view of this master starts with nothing in flight
+            self.quorum = QuorumTracker(self.get_f(), self.config.max_in_flight)
+            self.slot_futures = {}
+            self.committed_slots = []
+            self.batch_timer = None
@@ -0,0 +1,50 @@
+import time
+from message import Operation, OperationBatch
+
+
+class RequestBatcher(object):
+    """
+    Collects the client operations that arrive within a time window into one
+    OperationBatch, the batch is closed early once it reaches max_size
+    operations or max_bytes of operation payload.
+    """
+
+    def __init__(self, max_size, window, max_bytes):
+        assert max_size > 1 and window > 0
+        self.max_size = max_size
+        # window in seconds, counted from the first operation of the batch
+        self.window = window
+        self.max_bytes = max_bytes
+        self.operations = []
+        self.client_addresses = []
+        self.bytes = 0
+        self.opened_at = None
+
+    def add(self, operation: Operation, client_address):
+        """
+        :return: whether the batch is full and should be flushed now
+        """
+        if not self.operations:
+            self.opened_at = time.monotonic()
+        self.operations.append(operation)
+        self.client_addresses.append(client_address)
+        self.bytes += len(operation.uid or '') + len(operation.message or '')
+        return len(self.operations) >= self.max_size or self.bytes >= self.max_bytes
+
+    def time_left(self):
+        """
+        :return: seconds until the window closes, None if the batch is empty
+        """
+        if not self.operations:
+            return None
+        return max(self.opened_at + self.window - time.monotonic(), 0)
+
+    def flush(self):
+        if not self.operations:
+            return None
+        batch = OperationBatch(self.operations, self.client_addresses)
+        self.operations = []
+        self.client_addresses = []
+        self.bytes = 0
+        self.opened_at = None
+        return batch
@@ -0,0 +1,273 @@
+import argparse
+import os
+import queue
+import random
+import secrets
+import tempfile
+import time
+from multiprocessing import Process, Pipe, Queue, Manager
+import codec
+from message import *
+from ring import RingBuffer
+from server_state import ServerState
+from wal import WriteAheadLog, FSYNC_POLICIES
+
+
+class QuietState(ServerState):
+    # keep the sanity check prints out of the measurements
+    def digest_state(self):
+        pass
+
+
+def sample_messages():
+    operation = Operation(secrets.token_hex(16), secrets.token_urlsafe(16))
+    proposal = Proposal(0, 0, ('127.0.0.1', 40000), 42, operation)
+    return [
+        HeartBeat(1, need_reply=True, sent_at=time.monotonic()),
+        operation,
+        ClientRequest(operation),
+        ClientReply(True, operation, 0, 0),
+        proposal,
+        Accept(1, proposal),
+        IAmLeader(1, 0, 8),
+        PreVoteRequest(1, 1),
+        PreVoteReply(2, 1, True),
+        YouAreLeader(1, {slot: Proposal(0, 0, ('127.0.0.1', 40000), slot, operation) for slot in range(8, 16)},
+                     view_modulo=1, execute_slot=12, chunk=0, chunks=2),
+        ReplicaReady(1),
+        ReadReply(secrets.token_hex(16), True, 8, 16, {slot: operation for slot in range(8, 16)}),
+    ]
+
+
+def _ns_per_call(func, arg, repeat):
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter_ns() - start) / repeat
+
+
+def bench_codec(args):
+    print("%-14s %-11s %12s %12s %8s" % ("message", "codec", "encode ns", "decode ns", "bytes"))
+    for message in sample_messages():
+        for c in codec.CODECS.values():
+            raw = c.encode(message)
+            encode_ns = _ns_per_call(c.encode, message, args.n)
+            decode_ns = _ns_per_call(codec.decode, raw, args.n)
+            print("%-14s %-11s %12.0f %12.0f %8d" % (type(message).__name__, c.name, encode_ns, decode_ns, len(raw)))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def _commit(state, i):
+    operation = Operation(str(i), secrets.token_urlsafe(16))
+    proposal = state.propose_operation(operation, ('127.0.0.1', 40000))
+    state.learn_proposal(proposal)
+    return proposal.slot
+
+
+def bench_wal(args):
+    print("%-9s %8s %12s %12s %12s" % ("policy", "group", "commit/s", "p50 ms", "p99 ms"))
+    for policy in FSYNC_POLICIES:
+        with tempfile.TemporaryDirectory() as directory:
+            wal = WriteAheadLog(os.path.join(directory, 'state_0'), policy, args.interval)
+            state = QuietState(0, shared=False, wal=wal, snapshot_interval=args.snapshot_interval)
+            latencies = []
+            start = time.perf_counter()
+            for i in range(0, args.n, args.group):
+                # a group of commits decided together shares the sync before their replies are sent
+                started = []
+                for j in range(i, min(i + args.group, args.n)):
+                    started.append(time.perf_counter())
+                    _commit(state, j)
+                state.sync_log()
+                synced = time.perf_counter()
+                latencies.extend(synced - t for t in started)
+            elapsed = time.perf_counter() - start
+            print("%-9s %8d %12.0f %12.3f %12.3f" % (policy, args.group, args.n / elapsed,
+                                                     _percentile(latencies, 0.5) * 1000,
+                                                     _percentile(latencies, 0.99) * 1000))
+
+
+def _crash_worker(path, policy, snapshot_interval, connection):
+    state = QuietState(0, shared=False, wal=WriteAheadLog(path, policy), snapshot_interval=snapshot_interval)
+    i = state.execute_slot
+    while True:
+        slot = _commit(state, i)
+        state.sync_log()
+        # the commit is acknowledged only after the sync, like a reply to the client
+        connection.send(slot)
+        i += 1
+
+
+def bench_recovery(args):
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state_0')
+        for crash in range(args.crashes):
+            receiver, sender = Pipe(duplex=False)
+            p = Process(target=_crash_worker, args=(path, args.policy, args.snapshot_interval, sender))
+            p.start()
+            time.sleep(random.uniform(0.05, args.max_uptime))
+            p.kill()
+            p.join()
+            acknowledged = -1
+            while receiver.poll():
+                acknowledged = receiver.recv()
+            state = QuietState(0, shared=False, wal=WriteAheadLog(path, args.policy))
+            delivered = sorted(state.delivered_proposals.keys())
+            ok = state.execute_slot > acknowledged and delivered == list(range(state.execute_slot)) and \
+                all(proposal.operation.uid == str(slot) for slot, proposal in state.delivered_proposals.items())
+            failures += not ok
+            print("crash %3d: acknowledged up to slot %6d, recovered up to slot %6d, %s" % (
+                crash, acknowledged, state.execute_slot - 1, "ok" if ok else "LOST OR CORRUPTED"))
+    print("%d of %d recoveries failed" % (failures, args.crashes))
+
+
+def _learner(state, decided, apply_queue, delivered):
+    # a propose worker of the process engine, which learns its slot once it is decided
+    while True:
+        proposal = decided.get()
+        if proposal is None:
+            return
+        if apply_queue is None:
+            delivered.put([(p.slot, time.perf_counter()) for p in state.learn_proposal(proposal)])
+        else:
+            apply_queue.put([proposal])
+
+
+def _applier(state, apply_queue, delivered):
+    # the applier of the process engine, see Server.applier_worker
+    stop = False
+    while not stop:
+        proposals = []
+        batch = apply_queue.get()
+        while batch is not None:
+            proposals.extend(batch)
+            try:
+                batch = apply_queue.get_nowait()
+            except queue.Empty:
+                break
+        stop = batch is None
+        if proposals:
+            delivered.put([(p.slot, time.perf_counter()) for p in state.apply_learned(proposals)])
+
+
+def _contend(mode, in_flight, n):
+    # one master state shared by in_flight learners, the slots are proposed while at most in_flight are undelivered
+    state = QuietState(0, shared=True)
+    decided, delivered = Queue(), Queue()
+    apply_queue = None
+    workers = []
+    if mode == 'applier':
+        apply_queue = state.manager.Queue()
+        workers.append(Process(target=_applier, args=(state, apply_queue, delivered)))
+    learners = [Process(target=_learner, args=(state, decided, apply_queue, delivered)) for _ in range(in_flight)]
+    workers.extend(learners)
+    for p in workers:
+        p.start()
+    proposed_at = {}
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n):
+        while len(proposed_at) - len(latencies) >= in_flight:
+            latencies.extend(t - proposed_at[slot] for slot, t in delivered.get())
+        proposal = state.propose_operation(Operation(str(i), secrets.token_urlsafe(16)), ('127.0.0.1', 40000))
+        proposed_at[proposal.slot] = time.perf_counter()
+        decided.put(proposal)
+    while len(latencies) < n:
+        latencies.extend(t - proposed_at[slot] for slot, t in delivered.get())
+    elapsed = time.perf_counter() - start
+    for _ in learners:
+        decided.put(None)
+    if apply_queue is not None:
+        apply_queue.put(None)
+    for p in workers:
+        p.join()
+    state.manager.shutdown()
+    return n / elapsed, _percentile(latencies, 0.5), _percentile(latencies, 0.99)
+
+
+def bench_contention(args):
+    print("%-8s %10s %12s %12s %12s" % ("mode", "in flight", "deliver/s", "p50 ms", "p99 ms"))
+    for in_flight in (int(value) for value in args.in_flight.split(',')):
+        for mode in ('lock', 'applier'):
+            throughput, p50, p99 = _contend(mode, in_flight, args.n)
+            print("%-8s %10d %12.0f %12.3f %12.3f" % (mode, in_flight, throughput, p50 * 1000, p99 * 1000))
+
+
+def _producer(channel, start, n):
+    for slot in range(start, start + n):
+        if isinstance(channel, RingBuffer):
+            channel.put(slot, time.perf_counter_ns())
+        else:
+            channel.put((slot, time.perf_counter_ns()))
+
+
+def _transfer(kind, writers, n):
+    # writers processes put n (slot, send time) records in all, the one reader takes them out
+    manager = None
+    if kind == 'manager':
+        manager = Manager()
+        channel = manager.Queue()
+    elif kind == 'queue':
+        channel = Queue()
+    else:
+        channel = RingBuffer('qq', single_writer=writers == 1)
+    share = n // writers
+    producers = [Process(target=_producer, args=(channel, i * share, share)) for i in range(writers)]
+    start = time.perf_counter()
+    for p in producers:
+        p.start()
+    latencies = []
+    for _ in range(share * writers):
+        slot, sent = channel.get()
+        latencies.append(time.perf_counter_ns() - sent)
+    elapsed = time.perf_counter() - start
+    for p in producers:
+        p.join()
+    if manager is not None:
+        manager.shutdown()
+    return share * writers / elapsed, _percentile(latencies, 0.5) / 1e6, _percentile(latencies, 0.99) / 1e6
+
+
+def bench_queues(args):
+    print("%-8s %8s %12s %12s %12s" % ("channel", "writers", "records/s", "p50 ms", "p99 ms"))
+    for writers in (int(value) for value in args.writers.split(',')):
+        for kind in ('manager', 'queue', 'ring'):
+            throughput, p50, p99 = _transfer(kind, writers, args.n)
+            print("%-8s %8d %12.0f %12.3f %12.3f" % (kind, writers, throughput, p50, p99))
+
+
+parser = argparse.ArgumentParser(description='Micro benchmarks of the paxos chat components')
+subparsers = parser.add_subparsers(dest='bench')
+subparsers.required = True
+codec_parser = subparsers.add_parser('codec', help='encode and decode cost of every message per codec')
+codec_parser.add_argument('-n', default=10000, type=int, help='number of iterations per measurement')
+codec_parser.set_defaults(func=bench_codec)
+wal_parser = subparsers.add_parser('wal', help='commit latency of every fsync policy of the write ahead log')
+wal_parser.add_argument('-n', default=2000, type=int, help='number of commits per policy')
+wal_parser.add_argument('-group', default=8, type=int, help='commits sharing one sync')
+wal_parser.add_argument('-interval', default=0.05, type=float, help='seconds between fsyncs of the interval policy')
+wal_parser.add_argument('-snapshot_interval', default=1000, type=int, help='delivered slots between two snapshots')
+wal_parser.set_defaults(func=bench_wal)
+recovery_parser = subparsers.add_parser('recovery', help='kill a server state while it commits and check the replay')
+recovery_parser.add_argument('-crashes', default=10, type=int, help='number of kill and restore rounds')
+recovery_parser.add_argument('-policy', default='group', choices=FSYNC_POLICIES, help='fsync policy of the log')
+recovery_parser.add_argument('-max_uptime', default=0.5, type=float, help='max seconds before the kill')
+recovery_parser.add_argument('-snapshot_interval', default=100, type=int, help='delivered slots between two snapshots')
+recovery_parser.set_defaults(func=bench_recovery)
+contention_parser = subparsers.add_parser('contention', help='delivery of the shared state under the lock or by the applier')
+contention_parser.add_argument('-n', default=2000, type=int, help='number of slots per measurement')
+contention_parser.add_argument('-in_flight', default='1,2,4,8,16', type=str, help='concurrent learners in the form of 1,2,4')
+contention_parser.set_defaults(func=bench_contention)
+queues_parser = subparsers.add_parser('queues', help='records between processes through the manager, a pipe or the ring')
+queues_parser.add_argument('-n', default=20000, type=int, help='number of records per measurement')
+queues_parser.add_argument('-writers', default='1,4', type=str, help='writing processes in the form of 1,4')
+queues_parser.set_defaults(func=bench_queues)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -1,44 +1,80 @@
 import argparse
+import json
+import select
 import sys
 import time
 import random
 import secrets
 import jsonpickle
-from multiprocessing import Process
+from collections import OrderedDict, deque
+from multiprocessing import Process, Array
 import socket
 from message import *
 from config import ServerClusterConfig
+import codec
+from transport import DatagramChannel
+from histogram import LatencyHistogram
 
-MAX_PACKAGE_LENGTH = 4096
+# the max number of slots per ReadRequest
+READ_LIMIT = 100
+# sends of a request within the timeout, a retry carries the same operation uid so the master decides it once
+CLIENT_ATTEMPTS = 3
 
 
 class Client(object):
 
-    def __init__(self, config: ServerClusterConfig, timeout=1.0, message_loss=0.0, manual=False):
+    def __init__(self, config: ServerClusterConfig, timeout=1.0, message_loss=0.0, manual=False, group=0):
         self.manual = manual
         self.message_loss = message_loss
         self.timeout = timeout
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(("", 0))
-        self.addresses = config.get_all_replica_ip_port()
+        self.channel = DatagramChannel(self.socket, timeout)
+        self.config = config
+        # the consensus group, or chat room, every request goes to
+        self.group = group
+        self.addresses = config.get_all_replica_ip_port(group=group)
+        self.codec = codec.get_codec(config.codec)
+        # (view_modulo, master_uid) of the latest reply, shared with the worker processes, the master uid is -1
+        # until a reply and after a timeout, the requests go to every server then
+        self.leader = Array('q', [0, -1])
 
     def _send(self, address, byte: bytes):
         if random.uniform(0, 1) < self.message_loss:
             # message loss
             return
-        self.socket.sendto(byte, address)
+        self.channel.sendto(byte, address)
+
+    def encode(self, message: BaseMessage):
+        return self.codec.encode(message, self.group)
 
     def send_all(self, message: BaseMessage):
-        msg = str(message).encode("utf-8")
+        msg = self.encode(message)
         for address in self.addresses:
             self._send(address, msg)
 
+    def send_to_leader(self, message: BaseMessage):
+        master_uid = self.leader[1]
+        if master_uid < 0:
+            self.send_all(message)
+        else:
+            self._send(self.config.get_address(master_uid, self.group), self.encode(message))
+
+    def track_leader(self, reply):
+        # a later view has a higher view modulo, or the same one and a higher master uid
+        if reply.master_uid >= 0 and (reply.view_modulo, reply.master_uid) >= tuple(self.leader):
+            self.leader[0] = reply.view_modulo
+            self.leader[1] = reply.master_uid
+
+    def forget_leader(self):
+        self.leader[1] = -1
+
     def _receive(self) -> ClientReply:
         message = None
         while message is None:
             # print(self.socket.getsockname())
-            raw, address = self.socket.recvfrom(MAX_PACKAGE_LENGTH)
-            message = jsonpickle.decode(raw.decode("utf-8"))
+            raw, address = self.channel.recvfrom()
+            message = codec.decode(raw)
         assert isinstance(message, ClientReply)
         return message
 
@@ -46,15 +82,25 @@ class Client(object):
         print("requesting message: {uid: %s, message: %s}" % (uid, body))
         operation = Operation(uid, body)
         request = ClientRequest(operation)
-        self.send_all(request)
+        self.send_to_leader(request)
+        self.socket.settimeout(self.timeout / CLIENT_ATTEMPTS)
         while True:
             print("waiting for reply")
-            reply = self._receive()
+            try:
+                reply = self._receive()
+            except socket.timeout:
+                # the request or its reply may be lost, the master may be dead, ask everyone
+                print("retrying")
+                self.send_all(request)
+                continue
             if operation == reply.operation:
                 if reply.success:
+                    self.track_leader(reply)
                     print("message send success")
                     return
                 else:
+                    # maybe an old master, ask everyone next time
+                    self.forget_leader()
                     print("message send failed")
             else:
                 reason = ""
@@ -62,6 +108,68 @@ class Client(object):
                     reason = "uid mismatch"
                 sys.stderr.write("Error: Client receiving random reply: %s" % reason)
 
+    def read_once(self, request: ReadRequest, address=None):
+        """
+        Send the request to the server at address, or to the master and wait for it to succeed
+        :return: the reply, None if there was none within the timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        if address is None:
+            self.send_to_leader(request)
+        else:
+            self._send(address, self.encode(request))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.socket.settimeout(remaining)
+            try:
+                raw, _ = self.channel.recvfrom()
+            except socket.timeout:
+                break
+            reply = codec.decode(raw)
+            # an old master without the lease fails at once, the new one may still answer
+            if isinstance(reply, ReadReply) and reply.uid == request.uid and (reply.success or address is not None):
+                self.track_leader(reply)
+                return reply
+        if address is None:
+            self.forget_leader()
+        return None
+
+    def read_history(self, start_slot=0, min_slot=0, max_staleness=0.0, retry=3):
+        """
+        Read the operations delivered from start_slot on, READ_LIMIT slots per request
+        With max_staleness every request goes to a single server, the next one while they are too far behind,
+        otherwise to every server and only the master under its lease answers
+        :return: {slot: Operation or OperationBatch}, None if a request got no reply
+        """
+        operations = {}
+        # the server of a bounded read, starting at a random one
+        server = random.randrange(len(self.addresses))
+        attempts = retry * len(self.addresses) if max_staleness else retry
+        try:
+            while True:
+                request = ReadRequest(secrets.token_hex(16), start_slot, READ_LIMIT, min_slot, max_staleness)
+                reply = None
+                for _ in range(attempts):
+                    address = self.addresses[server] if max_staleness else None
+                    reply = self.read_once(request, address)
+                    if reply is not None and reply.success:
+                        break
+                    server = (server + 1) % len(self.addresses)
+                if reply is None or not reply.success:
+                    return None
+                # json do not allow int key
+                for slot, operation in reply.operations.items():
+                    operations[int(slot)] = operation
+                if reply.end_slot - reply.start_slot < READ_LIMIT:
+                    return operations
+                start_slot = reply.end_slot
+                # the next page is not read from a server behind this one
+                min_slot = max(min_slot, reply.end_slot)
+        finally:
+            self.socket.settimeout(None)
+
     def main(self):
         while True:
             uid = secrets.token_hex(16)
@@ -74,15 +182,256 @@ class Client(object):
             p.join(self.timeout)
             if p.is_alive():
                 p.terminate()
+                self.forget_leader()
                 print("message send timeout")
 
 
+class LoadGenerator(Client):
+    """
+    Keeps many requests in flight from one nonblocking socket instead of a process per message.
+        closed: keeps concurrency requests outstanding, a new one is sent as soon as one completes
+        open: sends rate requests per second whatever the replies, the latency is counted from
+              the scheduled send time so a stalled cluster is not hidden by a stalled client
+    """
+
+    def __init__(self, config: ServerClusterConfig, timeout=1.0, message_loss=0.0,
+                 mode='closed', concurrency=8, rate=100.0, duration=10.0, size=16, interval=1.0, read_ratio=0.0,
+                 max_staleness=0.0, retry=0.0, group=0):
+        super(LoadGenerator, self).__init__(config, timeout, message_loss, group=group)
+        self.socket.setblocking(False)
+        self.mode = mode
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.size = size
+        self.interval = interval
+        # the share of requests reading the operations delivered since the previous read instead of writing
+        self.read_ratio = read_ratio
+        self.read_slot = 0
+        self.reads = 0
+        # reads within max_staleness go to the servers in turn, the reads without staleness to every server
+        self.max_staleness = max_staleness
+        self.read_server = 0
+        # seconds until an unanswered request is sent again with the same uid, 0 never
+        self.retry = retry
+        self.retries = 0
+        # (due, uid) of the requests to send again in send order, and {uid: request} of those outstanding
+        self.retry_queue = deque()
+        self.requests = {}
+        self.uid_prefix = secrets.token_hex(8)
+        self.sent = 0
+        # {uid: sent at} in send order, so the timeouts expire from the front
+        self.outstanding = OrderedDict()
+        self.latency = LatencyHistogram()
+        self.read_latency = LatencyHistogram()
+        self.failed = 0
+        self.timeouts = 0
+        # replies to requests already timed out or answered
+        self.late = 0
+        # successful replies per interval
+        self.throughput = [0]
+        # wall clock time of the monotonic start, and the longest time without a successful reply
+        self.start = 0.0
+        self.started_at = 0.0
+        self.last_success = 0.0
+        self.stall = (0.0, 0.0, 0.0)
+
+    def send_request(self, sent_at):
+        uid = '%s-%d' % (self.uid_prefix, self.sent)
+        self.sent += 1
+        self.outstanding[uid] = sent_at
+        if self.read_ratio and random.uniform(0, 1) < self.read_ratio:
+            self.reads += 1
+            # the reads are monotonic, a server behind the previous read fails
+            request = ReadRequest(uid, self.read_slot, READ_LIMIT, self.read_slot, self.max_staleness)
+            if self.max_staleness:
+                self.read_server = (self.read_server + 1) % len(self.addresses)
+                self._send(self.addresses[self.read_server], self.encode(request))
+            else:
+                self.send_to_leader(request)
+        else:
+            request = ClientRequest(Operation(uid, secrets.token_urlsafe(self.size)))
+            self.send_to_leader(request)
+            if self.retry:
+                self.requests[uid] = request
+                self.retry_queue.append((sent_at + self.retry, uid))
+
+    def resend_due(self, now):
+        while self.retry_queue and self.retry_queue[0][0] <= now:
+            _, uid = self.retry_queue.popleft()
+            request = self.requests.get(uid)
+            if request is None:
+                # answered or timed out
+                continue
+            self.retries += 1
+            # the request or its reply may be lost, the master may be dead, ask everyone
+            self.send_all(request)
+            self.retry_queue.append((now + self.retry, uid))
+
+    def receive_replies(self, start):
+        while True:
+            try:
+                raw, _ = self.channel.recvfrom()
+            except BlockingIOError:
+                return
+            now = time.monotonic()
+            reply = codec.decode(raw)
+            if isinstance(reply, ClientReply):
+                uid = reply.operation.uid
+                latency = self.latency
+            elif isinstance(reply, ReadReply):
+                uid = reply.uid
+                latency = self.read_latency
+                if reply.success:
+                    self.read_slot = max(self.read_slot, reply.end_slot)
+            else:
+                continue
+            sent_at = self.outstanding.pop(uid, None)
+            self.requests.pop(uid, None)
+            if sent_at is None:
+                self.late += 1
+            elif reply.success:
+                self.track_leader(reply)
+                latency.record(now - sent_at)
+                second = int((now - start) / self.interval)
+                while len(self.throughput) <= second:
+                    self.throughput.append(0)
+                self.throughput[second] += 1
+                self.mark_success(now)
+            else:
+                if isinstance(reply, ClientReply) or not self.max_staleness:
+                    # maybe an old master, ask everyone next time, a stale replica only fails its own read
+                    self.forget_leader()
+                self.failed += 1
+
+    def end_stall(self, now):
+        if now - self.last_success > self.stall[0]:
+            self.stall = (now - self.last_success, self.last_success, now)
+
+    def mark_success(self, now):
+        self.end_stall(now)
+        self.last_success = now
+
+    def wall_time(self, now):
+        return self.started_at + now - self.start
+
+    def expire(self, now):
+        while self.outstanding:
+            uid, sent_at = next(iter(self.outstanding.items()))
+            if sent_at + self.timeout > now:
+                return
+            del self.outstanding[uid]
+            self.requests.pop(uid, None)
+            self.timeouts += 1
+            self.forget_leader()
+
+    def run(self):
+        self.started_at = time.time()
+        start = time.monotonic()
+        self.start = self.last_success = start
+        end = start + self.duration
+        next_send = start
+        while True:
+            now = time.monotonic()
+            # timed out requests make room for the closed loop
+            self.expire(now)
+            self.resend_due(now)
+            if now < end:
+                if self.mode == 'closed':
+                    while len(self.outstanding) < self.concurrency:
+                        self.send_request(now)
+                else:
+                    while next_send <= now:
+                        self.send_request(next_send)
+                        next_send += 1.0 / self.rate
+            if now >= end and not self.outstanding:
+                break
+            # sleep until a reply, the next scheduled send or the oldest timeout
+            wake = end if now < end else now + self.timeout
+            if self.mode == 'open' and now < end:
+                wake = min(wake, next_send)
+            if self.outstanding:
+                wake = min(wake, next(iter(self.outstanding.values())) + self.timeout)
+            if self.retry_queue:
+                wake = min(wake, self.retry_queue[0][0])
+            select.select([self.socket], [], [], max(wake - now, 0))
+            self.receive_replies(start)
+        # a stall lasting until the end counts as well
+        self.end_stall(time.monotonic())
+        return self.result(time.monotonic() - start)
+
+    def result(self, elapsed):
+        return {
+            'mode': self.mode,
+            'concurrency': self.concurrency if self.mode == 'closed' else None,
+            'rate': self.rate if self.mode == 'open' else None,
+            'duration': self.duration,
+            'size': self.size,
+            'group': self.group,
+            'sent': self.sent,
+            'read_ratio': self.read_ratio,
+            'max_staleness': self.max_staleness,
+            'reads': self.reads,
+            'retries': self.retries,
+            'success': self.latency.total + self.read_latency.total,
+            'failed': self.failed,
+            'timeout': self.timeouts,
+            'late': self.late,
+            'throughput': (self.latency.total + self.read_latency.total) / elapsed,
+            'throughput_interval': self.interval,
+            'throughput_over_time': [count / self.interval for count in self.throughput],
+            'latency': self.latency.to_dict(),
+            'read_latency': self.read_latency.to_dict(),
+            # wall clock times, to line up with events outside the client like a killed master
+            'started_at': self.started_at,
+            'last_success': self.wall_time(self.last_success),
+            'longest_stall': {'seconds': self.stall[0],
+                              'from': self.wall_time(self.stall[1]), 'to': self.wall_time(self.stall[2])},
+        }
+
+
 parser = argparse.ArgumentParser(description='Start a new client')
 parser.add_argument('-c', default='config.json', type=str, help='the config filename')
 parser.add_argument('-manual', action='store_true', help='manually input message')
+parser.add_argument('-bench', default=None, choices=['closed', 'open'], help='run a load generator instead')
+parser.add_argument('-concurrency', default=8, type=int, help='outstanding requests of the closed loop')
+parser.add_argument('-rate', default=100.0, type=float, help='requests per second of the open loop')
+parser.add_argument('-duration', default=10.0, type=float, help='seconds of load')
+parser.add_argument('-size', default=16, type=int, help='random bytes of every message body')
+parser.add_argument('-interval', default=1.0, type=float, help='seconds per throughput over time sample')
+parser.add_argument('-read_ratio', default=0.0, type=float, help='share of the load generator requests which read')
+parser.add_argument('-read', default=None, type=int, help='print the chat history from this slot on instead')
+parser.add_argument('-min_slot', default=0, type=int, help='only read from a server which delivered every slot below')
+parser.add_argument('-max_staleness', default=0.0, type=float,
+                    help='seconds a server read from may be behind the master, 0 reads from the master')
+parser.add_argument('-retry', default=0.0, type=float,
+                    help='seconds until the load generator sends an unanswered request again, 0 never')
+parser.add_argument('-group', default=0, type=int, help='the consensus group, or chat room, to write to and read from')
+parser.add_argument('-out', default=None, type=str, help='json file of the results, printed if not set')
 
 if __name__ == '__main__':
     args = parser.parse_args()
     config = ServerClusterConfig.read_config(args.c)
-    client = Client(config, config.timeout, config.message_loss, manual=args.manual)
+    if args.bench is not None:
+        generator = LoadGenerator(config, config.timeout, config.message_loss, args.bench, args.concurrency,
+                                  args.rate, args.duration, args.size, args.interval, args.read_ratio,
+                                  args.max_staleness, args.retry, args.group)
+        result = json.dumps(generator.run(), indent=2)
+        if args.out is None:
+            print(result)
+        else:
+            with open(args.out, 'w') as f:
+                f.write(result)
+        exit()
+    client = Client(config, config.timeout, config.message_loss, manual=args.manual, group=args.group)
+    if args.read is not None:
+        history = client.read_history(args.read, args.min_slot, args.max_staleness)
+        if history is None:
+            print("read timeout")
+            exit(1)
+        for slot, operation in sorted(history.items()):
+            operations = operation.operations if isinstance(operation, OperationBatch) else [operation]
+            for operation in operations:
+                print("%s: %s" % (slot, operation.message))
+        exit()
     client.main()
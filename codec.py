@@ -0,0 +1,293 @@
+import copy
+import struct
+import jsonpickle
+from message import *
+
+# first byte of every binary datagram, jsonpickle output always starts with '{'
+MAGIC = 0xFA
+VERSION = 7
+
+# (magic, version, group)
+_HEADER = struct.Struct('!BBH')
+_TAG = struct.Struct('!B')
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+_BOOL = struct.Struct('!?')
+_LENGTH = struct.Struct('!I')
+_PORT = struct.Struct('!H')
+_NONE_LENGTH = 0xFFFFFFFF
+
+
+class CodecError(Exception):
+    pass
+
+
+def _write_int(parts, value):
+    parts.append(_INT.pack(value))
+
+
+def _read_int(view, offset):
+    return _INT.unpack_from(view, offset)[0], offset + _INT.size
+
+
+def _write_float(parts, value):
+    parts.append(_FLOAT.pack(value))
+
+
+def _read_float(view, offset):
+    return _FLOAT.unpack_from(view, offset)[0], offset + _FLOAT.size
+
+
+def _write_bool(parts, value):
+    parts.append(_BOOL.pack(value))
+
+
+def _read_bool(view, offset):
+    return _BOOL.unpack_from(view, offset)[0], offset + _BOOL.size
+
+
+def _write_str(parts, value):
+    if value is None:
+        parts.append(_LENGTH.pack(_NONE_LENGTH))
+    else:
+        raw = value.encode('utf-8')
+        parts.append(_LENGTH.pack(len(raw)))
+        parts.append(raw)
+
+
+def _read_str(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    if length == _NONE_LENGTH:
+        return None, offset
+    return str(view[offset:offset + length], 'utf-8'), offset + length
+
+
+def _write_bytes(parts, value):
+    parts.append(_LENGTH.pack(len(value)))
+    parts.append(value)
+
+
+def _read_bytes(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    return bytes(view[offset:offset + length]), offset + length
+
+
+def _write_address(parts, value):
+    if value is None:
+        _write_str(parts, None)
+    else:
+        _write_str(parts, value[0])
+        parts.append(_PORT.pack(value[1]))
+
+
+def _read_address(view, offset):
+    ip, offset = _read_str(view, offset)
+    if ip is None:
+        return None, offset
+    port = _PORT.unpack_from(view, offset)[0]
+    return (ip, port), offset + _PORT.size
+
+
+def _write_message(parts, value):
+    if value is None:
+        parts.append(_TAG.pack(0))
+        return
+    tag, schema = _SCHEMAS[type(value)]
+    parts.append(_TAG.pack(tag))
+    for name, kind in schema:
+        _WRITERS[kind](parts, getattr(value, name))
+
+
+def _read_message(view, offset):
+    tag = _TAG.unpack_from(view, offset)[0]
+    offset += _TAG.size
+    if tag == 0:
+        return None, offset
+    try:
+        cls, schema = _TAGS[tag]
+    except KeyError:
+        raise CodecError("unknown message tag %s" % tag)
+    # like jsonpickle, restore the attributes without calling __init__
+    message = cls.__new__(cls)
+    for name, kind in schema:
+        value, offset = _READERS[kind](view, offset)
+        setattr(message, name, value)
+    return message, offset
+
+
+def _write_proposals(parts, value: Dict[int, Proposal]):
+    parts.append(_LENGTH.pack(len(value)))
+    for slot, proposal in value.items():
+        _write_int(parts, int(slot))
+        _write_message(parts, proposal)
+
+
+def _read_proposals(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    result = {}
+    for _ in range(length):
+        slot, offset = _read_int(view, offset)
+        result[slot], offset = _read_message(view, offset)
+    return result, offset
+
+
+def _write_messages(parts, value):
+    parts.append(_LENGTH.pack(len(value)))
+    for message in value:
+        _write_message(parts, message)
+
+
+def _read_messages(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    result = []
+    for _ in range(length):
+        message, offset = _read_message(view, offset)
+        result.append(message)
+    return result, offset
+
+
+def _write_addresses(parts, value):
+    parts.append(_LENGTH.pack(len(value)))
+    for address in value:
+        _write_address(parts, address)
+
+
+def _read_addresses(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    result = []
+    for _ in range(length):
+        address, offset = _read_address(view, offset)
+        result.append(address)
+    return result, offset
+
+
+def _write_ints(parts, value):
+    parts.append(_LENGTH.pack(len(value)))
+    parts.append(struct.pack('!%dq' % len(value), *value))
+
+
+def _read_ints(view, offset):
+    length = _LENGTH.unpack_from(view, offset)[0]
+    offset += _LENGTH.size
+    result = list(struct.unpack_from('!%dq' % length, view, offset))
+    return result, offset + length * _INT.size
+
+
+_WRITERS = {
+    'int': _write_int,
+    'float': _write_float,
+    'bool': _write_bool,
+    'str': _write_str,
+    'bytes': _write_bytes,
+    'address': _write_address,
+    'message': _write_message,
+    'proposals': _write_proposals,
+    'messages': _write_messages,
+    'addresses': _write_addresses,
+    'ints': _write_ints,
+}
+
+_READERS = {
+    'int': _read_int,
+    'float': _read_float,
+    'bool': _read_bool,
+    'str': _read_str,
+    'bytes': _read_bytes,
+    'address': _read_address,
+    'message': _read_message,
+    'proposals': _read_proposals,
+    'messages': _read_messages,
+    'addresses': _read_addresses,
+    'ints': _read_ints,
+}
+
+# {class: (tag, [(attribute, kind)])}, never reuse a tag within a version
+_SCHEMAS = {
+    HeartBeat: (1, [('uid', 'int'), ('need_reply', 'bool'), ('sent_at', 'float')]),
+    Operation: (2, [('uid', 'str'), ('message', 'str')]),
+    ClientRequest: (3, [('operation', 'message')]),
+    ClientReply: (4, [('operation', 'message'), ('success', 'bool'), ('master_uid', 'int'), ('view_modulo', 'int')]),
+    Proposal: (5, [('master_uid', 'int'), ('view_modulo', 'int'), ('client_address', 'address'),
+                   ('slot', 'int'), ('operation', 'message')]),
+    Accept: (6, [('uid', 'int'), ('proposal', 'message')]),
+    IAmLeader: (7, [('uid', 'int'), ('view_modulo', 'int'), ('execute_slot', 'int')]),
+    YouAreLeader: (8, [('follower_uid', 'int'), ('learned', 'proposals'),
+                        ('checkpoint_slot', 'int'), ('checkpoint_hash', 'bytes'),
+                        ('view_modulo', 'int'), ('execute_slot', 'int'), ('chunk', 'int'), ('chunks', 'int')]),
+    ReplicaReady: (9, [('replica_uid', 'int')]),
+    OperationBatch: (10, [('operations', 'messages'), ('client_addresses', 'addresses')]),
+    Commit: (11, [('master_uid', 'int'), ('view_modulo', 'int'), ('commit_slot', 'int'), ('slots', 'ints')]),
+    AcceptRange: (12, [('uid', 'int'), ('master_uid', 'int'), ('view_modulo', 'int'),
+                       ('start_slot', 'int'), ('end_slot', 'int')]),
+    DigestCheck: (13, [('uid', 'int'), ('slot', 'int'), ('digest', 'bytes')]),
+    StatsRequest: (14, []),
+    StatsReply: (15, [('uid', 'int'), ('stats', 'str')]),
+    ProfileControl: (16, [('enable', 'bool')]),
+    ReadRequest: (17, [('uid', 'str'), ('start_slot', 'int'), ('limit', 'int'),
+                       ('min_slot', 'int'), ('max_staleness', 'float')]),
+    # the operations of a read reply are keyed by slot like the proposals of a YouAreLeader
+    ReadReply: (18, [('uid', 'str'), ('success', 'bool'), ('start_slot', 'int'), ('end_slot', 'int'),
+                     ('operations', 'proposals'), ('watermark', 'int'), ('staleness', 'float'),
+                     ('master_uid', 'int'), ('view_modulo', 'int')]),
+    PreVoteRequest: (19, [('uid', 'int'), ('view_modulo', 'int')]),
+    PreVoteReply: (20, [('uid', 'int'), ('view_modulo', 'int'), ('granted', 'bool')]),
+    CatchUp: (21, [('master_uid', 'int'), ('view_modulo', 'int'), ('learned', 'proposals'),
+                   ('checkpoint_slot', 'int'), ('checkpoint_hash', 'bytes')]),
+}
+
+_TAGS = {tag: (cls, schema) for cls, (tag, schema) in _SCHEMAS.items()}
+
+
+class JsonPickleCodec(object):
+    name = 'jsonpickle'
+
+    def encode(self, message: BaseMessage, group=0) -> bytes:
+        if group:
+            # tag a copy, the message itself may be kept in the log
+            message = copy.copy(message)
+            message.group = group
+        return str(message).encode("utf-8")
+
+
+class BinaryCodec(object):
+    """
+    Versioned binary encoding: a fixed (magic, version, group) header, the type tag
+    and then the fields of the message in the order of its schema.
+    Messages without a schema are sent with jsonpickle instead.
+    """
+    name = 'binary'
+
+    def encode(self, message: BaseMessage, group=0) -> bytes:
+        parts = [_HEADER.pack(MAGIC, VERSION, group)]
+        try:
+            _write_message(parts, message)
+        except KeyError:
+            # the message or one of its nested messages has no schema
+            return CODECS['jsonpickle'].encode(message, group)
+        return b''.join(parts)
+
+
+CODECS = {codec.name: codec for codec in (JsonPickleCodec(), BinaryCodec())}
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+def decode(raw: bytes) -> BaseMessage:
+    # every codec can be decoded by every node, so a cluster can switch codec gradually
+    if raw[0] != MAGIC:
+        # raw may be a memoryview of the receive buffer
+        return jsonpickle.decode(str(raw, "utf-8"))
+    if raw[1] != VERSION:
+        raise CodecError("unsupported codec version %s" % raw[1])
+    _, _, group = _HEADER.unpack_from(raw)
+    message, _ = _read_message(memoryview(raw), _HEADER.size)
+    if group:
+        message.group = group
+    return message
@@ -1,3 +1,4 @@
+import inspect
 import jsonpickle
 from typing import List
 
@@ -9,14 +10,90 @@ class ServerConfig(object):
         self.port = port
 
 
+ENGINES = ('process', 'asyncio')
+CODECS = ('jsonpickle', 'binary')
+COMMIT_MODES = ('broadcast', 'leader')
+FSYNC_POLICIES = ('always', 'group', 'interval')
+
+
 class ServerClusterConfig(object):
     def __init__(self, f,
                  servers_config: List[ServerConfig],
-                 timeout=0.5, message_loss=0):
+                 timeout=0.5, message_loss=0, engine='process', codec='jsonpickle',
+                 batch_size=1, batch_window=0.002, batch_bytes=1024, commit_mode='broadcast',
+                 range_ack=False, max_in_flight=1024,
+                 wal_dir=None, fsync_policy='group', fsync_interval=0.05, snapshot_interval=1000,
+                 log_retention=0, digest_interval=100, metrics=False, profile_dir='profiles',
+                 read_lease=False, dedup_capacity=10000, applier=False, groups=1,
+                 receive_workers=0, heartbeat_interval=0.0, phi_threshold=8.0):
         self.f = f
         self.message_loss = message_loss
         # timeout in seconds
         self.timeout = timeout
+        # 'process' forks workers per proposal, 'asyncio' runs the master on one event loop
+        assert engine in ENGINES
+        self.engine = engine
+        # wire format of the messages, every node can decode both
+        assert codec in CODECS
+        self.codec = codec
+        # the master packs up to batch_size client requests arriving within batch_window seconds
+        # or carrying batch_bytes of messages into one proposal, batch_size 1 disables batching
+        assert batch_size >= 1 and batch_window > 0
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.batch_bytes = batch_bytes
+        # 'broadcast' replicas send their accepts to everyone and learn by counting them,
+        # 'leader' replicas only send accepts to the master and learn from its Commit messages
+        assert commit_mode in COMMIT_MODES
+        self.commit_mode = commit_mode
+        # replicas acknowledge runs of accepted slots with one AcceptRange, only with the leader commit mode
+        assert not range_ack or commit_mode == 'leader'
+        self.range_ack = range_ack
+        # the max number of slots the asyncio master has in flight, later requests wait for a free one
+        assert max_in_flight >= 1
+        self.max_in_flight = max_in_flight
+        # the servers write their state to a write ahead log in wal_dir, None keeps it in memory only
+        # the log is fsynced on every record, before a message is sent (group) or every fsync_interval seconds
+        assert wal_dir is None or engine == 'asyncio'
+        assert fsync_policy in FSYNC_POLICIES
+        self.wal_dir = wal_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        # delivered slots between two snapshots of the log
+        self.snapshot_interval = snapshot_interval
+        # delivered slots kept in memory, older ones are compacted into a checkpoint hash, 0 keeps all
+        assert log_retention == 0 or engine == 'asyncio'
+        self.log_retention = log_retention
+        # the master sends its log digest to the replicas every digest_interval delivered slots, 0 never
+        self.digest_interval = digest_interval
+        # the servers count messages and time their hot paths, answered to a StatsRequest,
+        # only by the asyncio engine, which forks no worker whose metrics would never be reported
+        assert not metrics or engine == 'asyncio'
+        self.metrics = metrics
+        # the stack samples of a server are written to profile_dir/server_<uid>.collapsed
+        self.profile_dir = profile_dir
+        # the master renews a lease with heartbeats and answers reads from its log while a majority granted it
+        self.read_lease = read_lease
+        # the master answers a retried request from the slot of its operation uid, among the last dedup_capacity
+        # operations, instead of deciding it again, 0 disables it
+        self.dedup_capacity = dedup_capacity
+        # the process engine delivers the decided slots in one applier process fed by a queue,
+        # instead of in every worker under the lock of the shared state
+        assert not applier or engine == 'process'
+        self.applier = applier
+        # independent consensus groups, chat rooms, each with its own log, view and master on every server,
+        # group g of a server listens on its port + g * the number of servers
+        assert groups >= 1
+        self.groups = groups
+        # processes receiving, decoding and encoding the messages of the master on its port with SO_REUSEPORT,
+        # 0 leaves it all to the process assigning the slots
+        assert receive_workers >= 0
+        self.receive_workers = receive_workers
+        # the master sends a heartbeat every heartbeat_interval seconds and the replicas suspect it once the phi of
+        # its silence reaches phi_threshold, 0 suspects it after a timeout without its messages and probes it then
+        assert heartbeat_interval >= 0 and 0 < phi_threshold <= 12
+        self.heartbeat_interval = heartbeat_interval
+        self.phi_threshold = phi_threshold
         self.servers_config = servers_config
         assert self.f * 2 + 1 == len(servers_config)
 
@@ -27,29 +104,38 @@ class ServerClusterConfig(object):
     def __index__(self, i):
         return self.servers_config[i]
 
-    def get_address(self, uid):
+    def get_address(self, uid, group=0):
         config = self.servers_config[uid]
-        return config.ip, config.port
+        return config.ip, config.port + group * len(self.servers_config)
 
-    def get_all_replica_ip_port(self, self_uid=None):
+    def get_all_replica_ip_port(self, self_uid=None, group=0):
         result = []
         for config in self.servers_config:
             if self_uid != config.uid:
                 # exclude itself when self_uid is set
-                result.append((config.ip, config.port))
+                result.append(self.get_address(config.uid, group))
         return result
 
+    def initial_master(self, group=0):
+        # the masters of the groups are spread over the servers
+        return group % len(self.servers_config)
+
     @classmethod
     def read_config(cls, config_file='config.json'):
-        return jsonpickle.decode(open(config_file).read())
+        config = jsonpickle.decode(open(config_file).read())
+        # jsonpickle skips __init__, an option added after the file was written takes its default
+        for name, parameter in inspect.signature(cls.__init__).parameters.items():
+            if parameter.default is not inspect.Parameter.empty and not hasattr(config, name):
+                setattr(config, name, parameter.default)
+        return config
 
     @classmethod
-    def generate_test_config(cls, f, config_file='config.json', timeout=0.5, message_loss=0):
+    def generate_test_config(cls, f, config_file='config.json', timeout=0.5, message_loss=0, **options):
         ip = 'localhost'
         servers_config = []
         for i in range(2 * f + 1):
             c = ServerConfig(uid=i, ip=ip, port=i + 23333)
             servers_config.append(c)
         cluster_config = ServerClusterConfig(f=f, servers_config=servers_config,
-                                             timeout=timeout, message_loss=message_loss)
+                                             timeout=timeout, message_loss=message_loss, **options)
         cluster_config.write_config(config_file)
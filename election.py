@@ -0,0 +1,67 @@
+import random
+
+FOLLOWER = 'follower'
+CANDIDATE = 'candidate'
+LEADER = 'leader'
+
+# failed elections in a row which double the random backoff, no more
+MAX_DOUBLINGS = 5
+
+
+def next_view(uid, view_modulo, master_uid):
+    # the first view above (view_modulo, master_uid) led by uid, views are ordered by view modulo then master uid
+    if uid > master_uid:
+        return view_modulo, uid
+    return view_modulo + 1, uid
+
+
+class Election(object):
+    """
+    The role of a server, follower, candidate or leader, and when it may stand for election.
+    Once the master is suspected, the servers after it in uid order stand one step apart, so the first live
+    one is usually elected before the others stand, and a candidate first needs a pre-vote of f servers
+    which lost the master as well, so a server cut off from a live master does not depose it.
+    Every failed election in a row doubles a random extra wait, so candidates which stood together do not
+    keep colliding.
+    """
+
+    def __init__(self, uid, servers, step, role=FOLLOWER):
+        self.uid = uid
+        self.servers = servers
+        self.step = step
+        self.role = role
+        self.failures = 0
+        # the candidate this server granted a pre-vote to is given a step before this one stands
+        self.hold_until = 0.0
+
+    def rank(self, master_uid):
+        # 0 for the server after the master, the master itself, a failed candidate, is last
+        return (self.uid - master_uid - 1) % self.servers
+
+    def backoff(self, master_uid):
+        """
+        :return: seconds to wait after suspecting master_uid before standing for election
+        """
+        wait = self.rank(master_uid) * self.step
+        if self.failures:
+            wait += random.uniform(0, self.step * 2 ** min(self.failures, MAX_DOUBLINGS))
+        return wait
+
+    def stand(self):
+        self.role = CANDIDATE
+
+    def hold(self, now):
+        self.hold_until = now + self.step
+
+    def won(self):
+        self.failures = 0
+        self.role = LEADER
+
+    def lost(self):
+        self.failures += 1
+        self.role = FOLLOWER
+
+    def follow(self):
+        # a leader of another server was found, the next election starts without backoff again
+        self.failures = 0
+        self.role = FOLLOWER
@@ -4,7 +4,8 @@ class DeadMasterError(Exception):
 
 class FollowNewMasterError(Exception):
     # a new master sends I am leader message trying to promote
-    def __init__(self, master_uid, view_modulo):
+    def __init__(self, master_uid, view_modulo, execute_slot=0):
         self.master_uid = master_uid
         self.view_modulo = view_modulo
+        self.execute_slot = execute_slot
         super(FollowNewMasterError, self).__init__()
@@ -0,0 +1,65 @@
+import math
+from collections import deque
+from statistics import NormalDist
+
+
+class PhiAccrualDetector(object):
+    """
+    Suspects the master once its silence is unlikely given the intervals between its recent heartbeats,
+    the phi accrual failure detector of Hayashibara et al.
+    The intervals of the last window heartbeats are taken as normally distributed, phi is -log10 of the
+    probability that the next heartbeat is still to come after the silence, and the master is suspected
+    once phi reaches the threshold. Any message of the master ends the silence, only its heartbeats are
+    sampled. The acceptable pause is added to the mean interval and the standard deviation is at least
+    min_std, so a master that was punctual so far is not suspected for a short hiccup, and the silence
+    is never longer than max_silence.
+    """
+
+    def __init__(self, threshold, expected_interval, acceptable_pause, min_std, max_silence, now, window=100):
+        # 1 - 10 ** -threshold has to stay below 1 in a float
+        assert 0 < threshold <= 12
+        self.threshold = threshold
+        self.acceptable_pause = acceptable_pause
+        self.min_std = min_std
+        self.max_silence = max_silence
+        self.intervals = deque(maxlen=window)
+        # running sums of the intervals in the window and of their squares
+        self.total = 0.0
+        self.squares = 0.0
+        # the first heartbeat is judged by the expected interval
+        self.add_interval(expected_interval)
+        self.heartbeat_at = now
+        self.heard_at = now
+
+    def add_interval(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            oldest = self.intervals[0]
+            self.total -= oldest
+            self.squares -= oldest * oldest
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+    def heartbeat(self, now):
+        self.add_interval(now - self.heartbeat_at)
+        self.heartbeat_at = now
+        self.heard_at = now
+
+    def heard(self, now):
+        self.heard_at = now
+
+    def distribution(self):
+        mean = self.total / len(self.intervals)
+        std = math.sqrt(max(self.squares / len(self.intervals) - mean * mean, 0.0))
+        return NormalDist(mean + self.acceptable_pause, max(std, self.min_std))
+
+    def phi(self, now):
+        later = 1.0 - self.distribution().cdf(now - self.heard_at)
+        return math.inf if later <= 0.0 else -math.log10(later)
+
+    def suspicion_timeout(self):
+        # the silence at which phi reaches the threshold
+        return min(self.distribution().inv_cdf(1.0 - 10 ** -self.threshold), self.max_silence)
+
+    def suspected_at(self):
+        return self.heard_at + self.suspicion_timeout()
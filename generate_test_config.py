@@ -1,15 +1,51 @@
 import argparse
-from config import ServerClusterConfig, ServerConfig
+from config import ServerClusterConfig, ServerConfig, ENGINES, CODECS, COMMIT_MODES, FSYNC_POLICIES
 
 parser = argparse.ArgumentParser(description='Generate a test config file of that tolerates f failure')
 parser.add_argument('-f', default=1, type=int, help='the number of tolerating failures')
 parser.add_argument('-c', default='config.json', type=str, help='the config filename')
 parser.add_argument('-loss', default=0.0, type=float, help='the message loss ratio')
 parser.add_argument('-timeout', default=0.5, type=float, help='the message timeout setting')
+parser.add_argument('-engine', default='process', choices=ENGINES, help='the server engine')
+parser.add_argument('-codec', default='jsonpickle', choices=CODECS, help='the message wire format')
+parser.add_argument('-batch_size', default=1, type=int, help='max client requests per proposal, 1 disables batching')
+parser.add_argument('-batch_window', default=0.002, type=float, help='seconds the master waits to fill a batch')
+parser.add_argument('-batch_bytes', default=1024, type=int, help='max message bytes per batch')
+parser.add_argument('-commit_mode', default='broadcast', choices=COMMIT_MODES, help='how replicas learn decisions')
+parser.add_argument('-range_ack', action='store_true', help='acknowledge runs of slots at once, needs leader commit')
+parser.add_argument('-max_in_flight', default=1024, type=int, help='max slots in flight on the asyncio master')
+parser.add_argument('-wal_dir', default=None, type=str, help='directory of the write ahead logs, needs asyncio engine')
+parser.add_argument('-fsync_policy', default='group', choices=FSYNC_POLICIES, help='when the log is fsynced')
+parser.add_argument('-fsync_interval', default=0.05, type=float, help='seconds between fsyncs of the interval policy')
+parser.add_argument('-snapshot_interval', default=1000, type=int, help='delivered slots between two snapshots')
+parser.add_argument('-log_retention', default=0, type=int, help='delivered slots kept before compaction, 0 keeps all')
+parser.add_argument('-digest_interval', default=100, type=int, help='delivered slots between two digest checks')
+parser.add_argument('-metrics', action='store_true', help='collect the metrics of the servers, see stats.py, needs asyncio engine')
+parser.add_argument('-profile_dir', default='profiles', type=str, help='directory of the stack samples of the servers')
+parser.add_argument('-read_lease', action='store_true', help='the master answers reads under a heartbeat lease')
+parser.add_argument('-dedup_capacity', default=10000, type=int, help='operation uids the master remembers, 0 disables')
+parser.add_argument('-applier', action='store_true', help='deliver in one applier process, needs process engine')
+parser.add_argument('-groups', default=1, type=int, help='independent consensus groups, chat rooms, per server')
+parser.add_argument('-receive_workers', default=0, type=int, help='processes decoding the messages of the master')
+parser.add_argument('-heartbeat_interval', default=0.0, type=float, help='seconds between heartbeats, 0 disables')
+parser.add_argument('-phi_threshold', default=8.0, type=float, help='phi at which the replicas suspect the master')
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    ServerClusterConfig.generate_test_config(args.f, args.c, message_loss=args.loss, timeout=args.timeout)
+    ServerClusterConfig.generate_test_config(args.f, args.c, message_loss=args.loss, timeout=args.timeout,
+                                             engine=args.engine, codec=args.codec, batch_size=args.batch_size,
+                                             batch_window=args.batch_window, batch_bytes=args.batch_bytes,
+                                             commit_mode=args.commit_mode, range_ack=args.range_ack,
+                                             max_in_flight=args.max_in_flight, wal_dir=args.wal_dir,
+                                             fsync_policy=args.fsync_policy, fsync_interval=args.fsync_interval,
+                                             snapshot_interval=args.snapshot_interval,
+                                             log_retention=args.log_retention, digest_interval=args.digest_interval,
+                                             metrics=args.metrics, profile_dir=args.profile_dir,
+                                             read_lease=args.read_lease, dedup_capacity=args.dedup_capacity,
+                                             applier=args.applier, groups=args.groups,
+                                             receive_workers=args.receive_workers,
+                                             heartbeat_interval=args.heartbeat_interval,
+                                             phi_threshold=args.phi_threshold)
     config = ServerClusterConfig.read_config(args.c)
     # print(config.get_all_replica_ip_port())
     pass
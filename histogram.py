@@ -0,0 +1,80 @@
+class LatencyHistogram(object):
+    """
+    Counts latencies in microsecond buckets, exact below 2 * SUB_BUCKETS and
+    SUB_BUCKETS buckets per power of two above, so the relative error of a
+    percentile is below 1 / SUB_BUCKETS and the memory does not grow with the samples.
+    """
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        # {bucket: count}
+        self.counts = {}
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucket(cls, us):
+        if us < 2 * cls.SUB_BUCKETS:
+            return us
+        shift = us.bit_length() - cls.SUB_BUCKETS.bit_length()
+        return shift * cls.SUB_BUCKETS + (us >> shift)
+
+    @classmethod
+    def upper_bound(cls, bucket):
+        # in microseconds, exclusive
+        if bucket < 2 * cls.SUB_BUCKETS:
+            return bucket + 1
+        shift = bucket // cls.SUB_BUCKETS - 1
+        return (bucket % cls.SUB_BUCKETS + cls.SUB_BUCKETS + 1) << shift
+
+    def record(self, seconds):
+        us = max(int(seconds * 1e6), 0)
+        bucket = self.bucket(us)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        :return: the upper bound in seconds of the bucket holding the p-th latency, 0 when empty
+        """
+        rank = p * self.total
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.upper_bound(bucket) / 1e6, self.max)
+        return 0.0
+
+    def to_dict(self):
+        # milliseconds, ready to be dumped as json
+        return {
+            'count': self.total,
+            'mean_ms': self.sum / self.total * 1000 if self.total else 0.0,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p90_ms': self.percentile(0.9) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'p999_ms': self.percentile(0.999) * 1000,
+            # [upper bound ms, count] of the non empty buckets
+            'buckets': [[self.upper_bound(bucket) / 1000, self.counts[bucket]] for bucket in sorted(self.counts)],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls()
+        for upper_ms, count in d['buckets']:
+            histogram.counts[cls.bucket(int(round(upper_ms * 1000)) - 1)] = count
+        histogram.total = d['count']
+        histogram.sum = d['mean_ms'] * d['count'] / 1000
+        histogram.max = d['max_ms'] / 1000
+        return histogram
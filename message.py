@@ -1,8 +1,11 @@
 import jsonpickle
-from typing import Dict
+from typing import Dict, List
 
 
 class BaseMessage(object):
+    # the consensus group the message belongs to, see ServerClusterConfig.groups, set by the codec
+    group = 0
+
     def __str__(self):
         return jsonpickle.encode(self)
 
@@ -16,9 +19,11 @@ class ReplicaReady(BaseMessage):
 
 
 class HeartBeat(BaseMessage):
-    def __init__(self, uid, need_reply):
+    def __init__(self, uid, need_reply, sent_at=0.0):
         self.uid = uid
         self.need_reply = need_reply
+        # the clock of the master when it renewed its lease with this heartbeat, echoed back by the reply
+        self.sent_at = sent_at
 
 
 class Operation(BaseMessage):
@@ -29,21 +34,44 @@ class Operation(BaseMessage):
     def if_nop(self):
         return self.uid is None
 
+    def uids(self):
+        return [] if self.if_nop() else [self.uid]
+
     def __eq__(self, other):
         return type(self) == type(other) and \
                self.uid == other.uid and \
                self.message == other.message
 
 
+class OperationBatch(BaseMessage):
+    # several client operations decided in a single slot, delivered in order
+    def __init__(self, operations: List[Operation] = None, client_addresses=None):
+        self.operations = [] if operations is None else operations
+        self.client_addresses = [] if client_addresses is None else client_addresses
+
+    def if_nop(self):
+        return False
+
+    def uids(self):
+        return [operation.uid for operation in self.operations]
+
+    def __eq__(self, other):
+        return type(self) == type(other) and \
+               self.operations == other.operations
+
+
 class ClientRequest(BaseMessage):
     def __init__(self, operation: Operation):
         self.operation = operation
 
 
 class ClientReply(BaseMessage):
-    def __init__(self, success, operation: Operation):
+    def __init__(self, success, operation: Operation, master_uid=-1, view_modulo=0):
         self.operation = operation
         self.success = success
+        # the master and view of the replying server, so the client sends to the master only, -1 if unknown
+        self.master_uid = master_uid
+        self.view_modulo = view_modulo
 
 
 class Proposal(BaseMessage):
@@ -73,15 +101,128 @@ class Accept(BaseMessage):
         self.proposal = proposal
 
 
+class AcceptRange(BaseMessage):
+    # the replica accepted the proposals of the master in every slot of [start_slot, end_slot)
+    def __init__(self, uid, master_uid, view_modulo, start_slot, end_slot):
+        self.uid = uid
+        self.master_uid = master_uid
+        self.view_modulo = view_modulo
+        self.start_slot = start_slot
+        self.end_slot = end_slot
+
+
+class Commit(BaseMessage):
+    # the master decided the given slots and every slot below commit_slot
+    def __init__(self, master_uid, view_modulo, commit_slot, slots: List[int]):
+        self.master_uid = master_uid
+        self.view_modulo = view_modulo
+        self.commit_slot = commit_slot
+        self.slots = slots
+
+
+class DigestCheck(BaseMessage):
+    # the hash of every operation the master delivered below slot, for replicas to detect divergence
+    def __init__(self, uid, slot, digest: bytes):
+        self.uid = uid
+        self.slot = slot
+        self.digest = digest
+
+
 class IAmLeader(BaseMessage):
+    def __init__(self, uid, view_modulo, execute_slot=0):
+        self.uid = uid
+        self.view_modulo = view_modulo
+        # the candidate delivered every slot below it, followers only send the slots above
+        self.execute_slot = execute_slot
+
+
+class PreVoteRequest(BaseMessage):
+    # asks whether the servers lost the master as well before the candidate uid stands for the view
     def __init__(self, uid, view_modulo):
         self.uid = uid
         self.view_modulo = view_modulo
 
 
+class PreVoteReply(BaseMessage):
+    def __init__(self, uid, view_modulo, granted):
+        self.uid = uid
+        # the view of the request, replies to an earlier pre-vote of the candidate are ignored
+        self.view_modulo = view_modulo
+        self.granted = granted
+
+
 class YouAreLeader(BaseMessage):
-    def __init__(self, follower_uid, learned: Dict[int, Proposal]):
+    def __init__(self, follower_uid, learned: Dict[int, Proposal], checkpoint_slot=0, checkpoint_hash=b'',
+                 view_modulo=0, execute_slot=0, chunk=0, chunks=1):
         self.follower_uid = follower_uid
+        # only the slots above the watermark of the candidate and the checkpoint
+        self.learned = learned
+        self.checkpoint_slot = checkpoint_slot
+        self.checkpoint_hash = checkpoint_hash
+        # the view this follower joins and the slot it delivered up to
+        self.view_modulo = view_modulo
+        self.execute_slot = execute_slot
+        # learned is split over chunks messages to fit in a datagram, this is the chunk-th
+        self.chunk = chunk
+        self.chunks = chunks
+
+
+class CatchUp(BaseMessage):
+    def __init__(self, master_uid, view_modulo, learned: Dict[int, Proposal], checkpoint_slot=0, checkpoint_hash=b''):
+        self.master_uid = master_uid
+        self.view_modulo = view_modulo
+        # slots delivered by the master which a follower joining late missed, they are decided already
         self.learned = learned
+        self.checkpoint_slot = checkpoint_slot
+        self.checkpoint_hash = checkpoint_hash
+
+
+class ReadRequest(BaseMessage):
+    # the operations delivered from start_slot on, answered from the log of a server without a proposal
+    def __init__(self, uid, start_slot=0, limit=100, min_slot=0, max_staleness=0.0):
+        self.uid = uid
+        self.start_slot = start_slot
+        # the max number of slots in the reply
+        self.limit = limit
+        # only a server which delivered every slot below min_slot and is at most max_staleness seconds behind
+        # its master answers, 0 is the master under its lease
+        self.min_slot = min_slot
+        self.max_staleness = max_staleness
+
+
+class ReadReply(BaseMessage):
+    def __init__(self, uid, success, start_slot=0, end_slot=0, operations: Dict[int, BaseMessage] = None,
+                 watermark=0, staleness=0.0, master_uid=-1, view_modulo=0):
+        self.uid = uid
+        # False when the server is behind the bounds of the request
+        self.success = success
+        # every slot in [start_slot, end_slot) is delivered, start_slot is above the requested one if compacted
+        self.start_slot = start_slot
+        self.end_slot = end_slot
+        # {slot: Operation or OperationBatch}, without the no-ops
+        self.operations = {} if operations is None else operations
+        # the server delivered every slot below the watermark and was staleness seconds behind its master
+        self.watermark = watermark
+        self.staleness = staleness
+        # like a ClientReply
+        self.master_uid = master_uid
+        self.view_modulo = view_modulo
+
+
+class StatsRequest(BaseMessage):
+    # asks a server for its metrics, answered with a StatsReply
+    def __init__(self):
+        pass
+
+
+class StatsReply(BaseMessage):
+    def __init__(self, uid, stats: str):
+        self.uid = uid
+        # json of the metrics, empty when the server runs without metrics
+        self.stats = stats
 
 
+class ProfileControl(BaseMessage):
+    # starts or stops the stack sampler of every process of a server
+    def __init__(self, enable):
+        self.enable = enable
@@ -0,0 +1,53 @@
+import json
+import time
+from histogram import LatencyHistogram
+
+
+class Metrics(object):
+    """
+    Counters, timing histograms and value distributions of one server process.
+    A server without metrics holds None instead, so every hook costs a single check.
+    The names are dotted, like received.Proposal or dispatch.ClientRequest.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        # {name: count}
+        self.counters = {}
+        # {name: LatencyHistogram}
+        self.timings = {}
+        # {name: {value: count}}
+        self.values = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def time(self, name, seconds):
+        histogram = self.timings.get(name)
+        if histogram is None:
+            histogram = self.timings[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def observe(self, name, value):
+        values = self.values.setdefault(name, {})
+        values[value] = values.get(value, 0) + 1
+
+    def to_dict(self, gauges=None):
+        timings = {}
+        for name, histogram in self.timings.items():
+            timing = histogram.to_dict()
+            timing.pop('buckets')
+            timings[name] = timing
+        return {
+            'uptime': time.time() - self.started_at,
+            # point in time values of the server, like its execute slot
+            'gauges': gauges or {},
+            'counters': dict(sorted(self.counters.items())),
+            'timings': dict(sorted(timings.items())),
+            # json only has string keys
+            'values': {name: {str(value): count for value, count in sorted(values.items())}
+                       for name, values in sorted(self.values.items())},
+        }
+
+    def to_json(self, gauges=None):
+        return json.dumps(self.to_dict(gauges))
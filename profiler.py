@@ -0,0 +1,146 @@
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+from multiprocessing import current_process, util
+
+# seconds between two samples of the stacks of every thread
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler(object):
+    """
+    A thread taking the stack of every other thread of the process every interval seconds,
+    the samples are counted per collapsed stack, the format of flamegraph.pl.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # {'outer;...;inner': samples}
+        self.stacks = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.record(frame)
+            time.sleep(self.interval)
+
+    def record(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class _Profile(object):
+    # the profile of this process, a fork of a profiled process profiles itself as well
+    def __init__(self):
+        self.sampler = None
+        self.directory = None
+        self.name = None
+        self.role = None
+
+
+_profile = _Profile()
+
+
+def is_running():
+    return _profile.sampler is not None
+
+
+def start(directory, name, role):
+    """
+    Sample this process until stop, the stacks are written to directory/name.<pid>.collapsed
+    with the role of the process as their root frame.
+    """
+    if is_running():
+        return
+    os.makedirs(directory, exist_ok=True)
+    _profile.directory = directory
+    _profile.name = name
+    _profile.role = role
+    _profile.sampler = StackSampler()
+    _profile.sampler.start()
+
+
+def stop():
+    if not is_running():
+        return
+    sampler = _profile.sampler
+    _profile.sampler = None
+    sampler.stop()
+    path = os.path.join(_profile.directory, '%s.%d.collapsed' % (_profile.name, os.getpid()))
+    with open(path, 'w') as f:
+        for stack, count in sampler.stacks.items():
+            f.write('%s;%s %d\n' % (_profile.role, stack, count))
+
+
+def _after_fork(profile: _Profile):
+    if profile.sampler is None:
+        return
+    # the samples of the parent stay with the parent, and its sampler thread did not survive the fork
+    profile.sampler = None
+    start(profile.directory, profile.name, current_process().name)
+    # forked workers skip atexit, the finalizers of multiprocessing run when they return
+    util.Finalize(None, stop, exitpriority=0)
+
+
+util.register_after_fork(_profile, _after_fork)
+
+
+def merge(directory, name):
+    """
+    Sum the samples of every process of name into directory/name.collapsed
+    :return: the path of the merged profile
+    """
+    stacks = {}
+    for path in glob.glob(os.path.join(directory, '%s.*.collapsed' % name)):
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack:
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+    merged_path = os.path.join(directory, '%s.collapsed' % name)
+    with open(merged_path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, count))
+    return merged_path
+
+
+def clear(directory, name):
+    # the profiles of the processes of a previous run
+    for path in glob.glob(os.path.join(directory, '%s.*.collapsed' % name)):
+        os.remove(path)
+
+
+parser = argparse.ArgumentParser(description='Merge the per process profiles of a server')
+parser.add_argument('-dir', default='profiles', type=str, help='the profile directory of the config')
+parser.add_argument('-uid', default=0, type=int, help='the server to merge the profiles of')
+parser.add_argument('-group', default=None, type=int, help='the group of the server, if the config has several')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    name = 'server_%s' % args.uid
+    if args.group is not None:
+        name += '_group_%s' % args.group
+    print(merge(args.dir, name))
@@ -0,0 +1,61 @@
+class QuorumTracker(object):
+    """
+    Counts the accepts of the in flight slots of the master.
+    Every slot owns the entry slot % window of a fixed size array, holding a
+    bitmask of the replicas that accepted it, so memory is bounded by the window.
+    A slot can only be opened while it is less than window slots above the
+    oldest slot still in flight.
+    """
+
+    def __init__(self, quorum, window):
+        self.quorum = quorum
+        self.window = window
+        # the slot tracked by each entry, None when the entry is free
+        self.slots = [None] * window
+        self.masks = [0] * window
+        # no slot below low is in flight
+        self.low = 0
+        self.in_flight = 0
+
+    def __len__(self):
+        return self.in_flight
+
+    def _advance(self, high):
+        while self.low < high and self.slots[self.low % self.window] != self.low:
+            self.low += 1
+
+    def has_room(self, slot):
+        self._advance(slot)
+        if slot < self.low:
+            # a slot proposed again after its timeout, unless a later slot took its entry
+            return self.slots[slot % self.window] is None
+        return slot - self.low < self.window
+
+    def open(self, slot):
+        assert self.has_room(slot)
+        if self.in_flight == 0 or slot < self.low:
+            self.low = slot
+        index = slot % self.window
+        self.slots[index] = slot
+        self.masks[index] = 0
+        self.in_flight += 1
+
+    def close(self, slot):
+        index = slot % self.window
+        if self.slots[index] == slot:
+            self.slots[index] = None
+            self.in_flight -= 1
+
+    def ack(self, slot, uid):
+        """
+        :return: True exactly once, when this accept completes the quorum of the slot
+        """
+        index = slot % self.window
+        if self.slots[index] != slot:
+            # decided, timed out or never proposed
+            return False
+        self.masks[index] |= 1 << uid
+        if bin(self.masks[index]).count('1') >= self.quorum:
+            self.close(slot)
+            return True
+        return False
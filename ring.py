@@ -0,0 +1,69 @@
+import queue
+import struct
+from multiprocessing import Lock, Semaphore
+from multiprocessing.shared_memory import SharedMemory
+
+# the next record to write, only moved by the writers, and the next record to read, only moved by the reader
+_CURSOR = struct.Struct('q')
+_HEAD = 0
+_TAIL = _CURSOR.size
+_RECORDS = 2 * _CURSOR.size
+
+
+class RingBuffer(object):
+    """
+    A bounded queue of fixed size records in shared memory, between the processes forked after it is created.
+    A record is packed straight into the buffer, nothing is pickled and no pipe or manager process is involved.
+    The semaphores count the records and the free room, so a reader waits for a record and a writer for room
+    without polling, and a record is only read after the semaphore which published it.
+    Several writers need a lock for the write cursor, a single writer and the single reader need none.
+    """
+
+    def __init__(self, record_format, capacity=1024, single_writer=True):
+        self.record = struct.Struct(record_format)
+        self.capacity = capacity
+        self.memory = SharedMemory(create=True, size=_RECORDS + capacity * self.record.size)
+        # only shared by fork, so the name is not needed and nothing is left behind if the processes are killed
+        self.memory.unlink()
+        _CURSOR.pack_into(self.memory.buf, _HEAD, 0)
+        _CURSOR.pack_into(self.memory.buf, _TAIL, 0)
+        self.records = Semaphore(0)
+        self.room = Semaphore(capacity)
+        self.lock = None if single_writer else Lock()
+
+    def _write(self, values):
+        head = _CURSOR.unpack_from(self.memory.buf, _HEAD)[0]
+        self.record.pack_into(self.memory.buf, _RECORDS + (head % self.capacity) * self.record.size, *values)
+        _CURSOR.pack_into(self.memory.buf, _HEAD, head + 1)
+
+    def put(self, *values, block=True, timeout=None):
+        if not self.room.acquire(block, timeout):
+            raise queue.Full()
+        if self.lock is None:
+            self._write(values)
+        else:
+            with self.lock:
+                self._write(values)
+        self.records.release()
+
+    def put_nowait(self, *values):
+        self.put(*values, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        :return: the values of the oldest record
+        """
+        if not self.records.acquire(block, timeout):
+            raise queue.Empty()
+        tail = _CURSOR.unpack_from(self.memory.buf, _TAIL)[0]
+        values = self.record.unpack_from(self.memory.buf, _RECORDS + (tail % self.capacity) * self.record.size)
+        _CURSOR.pack_into(self.memory.buf, _TAIL, tail + 1)
+        self.room.release()
+        return values
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def close(self):
+        # the mapping of this process, the forked ones keep theirs
+        self.memory.close()
@@ -1,30 +1,104 @@
 import argparse
+import csv
+import itertools
+import json
+import os
+import secrets
+import signal
+import socket
 import subprocess
+import tempfile
 import time
 from multiprocessing import Process
-from config import ServerClusterConfig
+from config import ServerClusterConfig, ENGINES, CODECS, COMMIT_MODES, FSYNC_POLICIES
+from histogram import LatencyHistogram
+from message import ClientRequest, ClientReply, Operation
+from transport import DatagramChannel
+import codec
 
 parser = argparse.ArgumentParser(description='Script mode to run the cluster')
+parser.add_argument('mode', nargs='?', default='run', choices=['run', 'bench', 'failover'],
+                    help='run the cluster with clients, run the benchmark suite, or time repeated master failovers')
 parser.add_argument('-f', default=2, type=int, help='number of tolerating failures')
 parser.add_argument('-c', default='config.json', type=str, help='the config filename')
 parser.add_argument('-skip_slots', default=None, type=str, help='skip slots in the form of 1,2,3,4')
 parser.add_argument('-client_n', default=3, type=int, help='number of clients')
 parser.add_argument('-loss', default=0.0, type=float, help='the message loss ratio')
 parser.add_argument('-timeout', default=0.5, type=float, help='the message timeout setting')
+parser.add_argument('-engine', default='process', choices=ENGINES, help='the server engine')
+parser.add_argument('-codec', default='jsonpickle', choices=CODECS, help='the message wire format')
+parser.add_argument('-batch_size', default=1, type=int, help='max client requests per proposal, 1 disables batching')
+parser.add_argument('-batch_window', default=0.002, type=float, help='seconds the master waits to fill a batch')
+parser.add_argument('-batch_bytes', default=1024, type=int, help='max message bytes per batch')
+parser.add_argument('-commit_mode', default='broadcast', choices=COMMIT_MODES, help='how replicas learn decisions')
+parser.add_argument('-range_ack', action='store_true', help='acknowledge runs of slots at once, needs leader commit')
+parser.add_argument('-max_in_flight', default=1024, type=int, help='max slots in flight on the asyncio master')
+parser.add_argument('-wal_dir', default=None, type=str, help='directory of the write ahead logs, needs asyncio engine')
+parser.add_argument('-fsync_policy', default='group', choices=FSYNC_POLICIES, help='when the log is fsynced')
+parser.add_argument('-fsync_interval', default=0.05, type=float, help='seconds between fsyncs of the interval policy')
+parser.add_argument('-snapshot_interval', default=1000, type=int, help='delivered slots between two snapshots')
+parser.add_argument('-log_retention', default=0, type=int, help='delivered slots kept before compaction, 0 keeps all')
+parser.add_argument('-digest_interval', default=100, type=int, help='delivered slots between two digest checks')
+parser.add_argument('-metrics', action='store_true', help='collect the metrics of the servers, see stats.py, needs asyncio engine')
+parser.add_argument('-profile_dir', default='profiles', type=str, help='directory of the stack samples of the servers')
+parser.add_argument('-read_lease', action='store_true', help='the master answers reads under a heartbeat lease')
+parser.add_argument('-dedup_capacity', default=10000, type=int, help='operation uids the master remembers, 0 disables')
+parser.add_argument('-applier', action='store_true', help='deliver in one applier process, needs process engine')
+parser.add_argument('-groups', default=1, type=int, help='independent consensus groups, chat rooms, per server')
+parser.add_argument('-receive_workers', default=0, type=int, help='processes decoding the messages of the master')
+parser.add_argument('-heartbeat_interval', default=0.0, type=float, help='seconds between heartbeats, 0 disables')
+parser.add_argument('-phi_threshold', default=8.0, type=float, help='phi at which the replicas suspect the master')
+# benchmark suite, every combination of the sweeps is one scenario
+parser.add_argument('-sweep_f', default='1,2,3', type=str, help='values of f in the form of 1,2,3')
+parser.add_argument('-sweep_clients', default='1,4', type=str, help='numbers of clients')
+parser.add_argument('-sweep_sizes', default='16,1024', type=str, help='random bytes of the message bodies')
+parser.add_argument('-sweep_loss', default='0', type=str, help='message loss ratios')
+parser.add_argument('-sweep_timeout', default='0.5', type=str, help='message timeouts')
+parser.add_argument('-sweep_skip_slots', default='none', type=str,
+                    help='skip slots of the initial master separated by ;, in the form of none;1,2,3')
+parser.add_argument('-duration', default=5.0, type=float, help='seconds of load per scenario')
+parser.add_argument('-concurrency', default=1, type=int, help='outstanding requests per client')
+parser.add_argument('-kill_at', default=0.5, type=float,
+                    help='fraction of the duration the master is killed at in an extra run per scenario, 0 disables')
+parser.add_argument('-results', default='bench_results.csv', type=str, help='the csv file of the results table')
+parser.add_argument('-failovers', default=20, type=int, help='masters paused one after the other by the failover mode')
+parser.add_argument('-settle', default=1.0, type=float,
+                    help='seconds between a failover and the next pause, the paused master resumes meanwhile')
 
 
-def generate_config_file(config, f, loss, timeout):
+# seconds between two sends of the write probing for a master
+PROBE_INTERVAL = 0.005
+
+# options passed through to generate_test_config.py as they are
+CONFIG_OPTIONS = ['engine', 'codec', 'batch_size', 'batch_window', 'batch_bytes', 'commit_mode',
+                  'range_ack', 'max_in_flight', 'wal_dir', 'fsync_policy', 'fsync_interval',
+                  'snapshot_interval', 'log_retention', 'digest_interval', 'metrics', 'profile_dir',
+                  'read_lease', 'dedup_capacity', 'applier', 'groups', 'receive_workers', 'heartbeat_interval',
+                  'phi_threshold']
+
+
+def generate_config_file(config, f, loss, timeout, **options):
     script = ["python", "generate_test_config.py"]
     script.extend(["-c", str(config)])
     script.extend(["-f", str(f)])
     script.extend(["-loss", str(loss)])
     script.extend(["-timeout", str(timeout)])
+    for name, value in options.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            # store_true flags
+            if value:
+                script.append("-" + name)
+        else:
+            script.extend(["-" + name, str(value)])
     subprocess.call(" ".join(script), shell=True)
 
 
-def run_client(config):
+def run_client(config, group=0):
     script = ["python", "client.py"]
     script.extend(["-c", str(config)])
+    script.extend(["-group", str(group)])
     subprocess.call(" ".join(script), shell=True)
 
 
@@ -37,9 +111,179 @@ def run_server(config, uid, skip_slots=None):
     subprocess.call(" ".join(script), shell=True)
 
 
+def start_server(config, uid, skip_slots=None):
+    script = ["python", "server.py", "-c", str(config), "-uid", str(uid)]
+    if skip_slots is not None:
+        script.extend(["-skip_slots", str(skip_slots)])
+    # a session of its own, so the forked workers are killed with the server
+    return subprocess.Popen(script, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def stop_server(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run_scenario(args, options, f, clients, size, loss, timeout, skip_slots, kill):
+    generate_config_file(args.c, f, loss, timeout, **options)
+    # the initial master first, otherwise the replicas start a view change,
+    # every server is the initial master of a group with several, so they start at once
+    servers = [start_server(args.c, 0, skip_slots)]
+    if options['groups'] == 1:
+        time.sleep(0.5)
+    servers.extend(start_server(args.c, uid) for uid in range(1, 2 * f + 1))
+    time.sleep(1)
+    killed_at = None
+    with tempfile.TemporaryDirectory() as directory:
+        outputs = [os.path.join(directory, 'client_%d.json' % i) for i in range(clients)]
+        # the clients are spread over the groups
+        client_processes = [subprocess.Popen(["python", "client.py", "-c", str(args.c), "-bench", "closed",
+                                              "-concurrency", str(args.concurrency), "-duration", str(args.duration),
+                                              "-size", str(size), "-group", str(i % options['groups']),
+                                              "-out", output]) for i, output in enumerate(outputs)]
+        if kill:
+            time.sleep(args.duration * args.kill_at)
+            killed_at = time.time()
+            stop_server(servers[0])
+        for process in client_processes:
+            process.wait()
+        results = []
+        for output in outputs:
+            with open(output) as file:
+                results.append(json.load(file))
+    for server in servers:
+        stop_server(server)
+
+    latency = LatencyHistogram()
+    for result in results:
+        latency.merge(LatencyHistogram.from_dict(result['latency']))
+    view_change = None
+    if killed_at is not None and all(result['last_success'] > killed_at for result in results):
+        # the clients are stalled from the kill until the new master replies
+        view_change = max(result['longest_stall']['to'] - killed_at for result in results
+                          if result['longest_stall']['from'] <= killed_at)
+    return {
+        'f': f, 'clients': clients, 'size': size, 'loss': loss, 'timeout': timeout,
+        'skip_slots': skip_slots or '', 'kill': kill,
+        'throughput': round(sum(result['throughput'] for result in results), 1),
+        'p50_ms': round(latency.percentile(0.5) * 1000, 3),
+        'p99_ms': round(latency.percentile(0.99) * 1000, 3),
+        'success': sum(result['success'] for result in results),
+        'timeout_count': sum(result['timeout'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+        'view_change_s': '' if view_change is None else round(view_change, 3),
+    }
+
+
+def bench(args, options):
+    def values(sweep, convert):
+        return [convert(value) for value in sweep.split(',')]
+
+    skip_slots = [None if value == 'none' else value for value in args.sweep_skip_slots.split(';')]
+    kills = [False, True] if args.kill_at > 0 else [False]
+    scenarios = itertools.product(values(args.sweep_f, int), values(args.sweep_clients, int),
+                                  values(args.sweep_sizes, int), values(args.sweep_loss, float),
+                                  values(args.sweep_timeout, float), skip_slots, kills)
+    columns = ['f', 'clients', 'size', 'loss', 'timeout', 'skip_slots', 'kill', 'throughput',
+               'p50_ms', 'p99_ms', 'success', 'timeout_count', 'failed', 'view_change_s']
+    row_format = "%3s %7s %6s %5s %7s %10s %5s %10s %9s %9s %8s %13s %6s %13s"
+    print(row_format % tuple(columns))
+    with open(args.results, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for scenario in scenarios:
+            row = run_scenario(args, options, *scenario)
+            print(row_format % tuple(row[column] for column in columns))
+            writer.writerow(row)
+            file.flush()
+
+
+def probe_master(config: ServerClusterConfig, timeout):
+    """
+    Send one write to every server until a master answers it, the retries carry the same operation uid
+    :return: (master uid, view modulo) of the reply, None if there was none within timeout
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("", 0))
+    channel = DatagramChannel(sock, timeout)
+    operation = Operation(secrets.token_hex(16), 'failover probe')
+    request = codec.get_codec(config.codec).encode(ClientRequest(operation))
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            for address in config.get_all_replica_ip_port():
+                channel.sendto(request, address)
+            resend_at = time.monotonic() + PROBE_INTERVAL
+            while time.monotonic() < resend_at:
+                sock.settimeout(max(resend_at - time.monotonic(), 0.001))
+                try:
+                    raw, _ = channel.recvfrom()
+                except socket.timeout:
+                    break
+                reply = codec.decode(raw)
+                if isinstance(reply, ClientReply) and reply.success and reply.operation.uid == operation.uid:
+                    return reply.master_uid, reply.view_modulo
+    finally:
+        sock.close()
+    return None
+
+
+def failover(args, options):
+    # a single group, whose master is paused with SIGSTOP until another server answers a write
+    generate_config_file(args.c, args.f, args.loss, args.timeout, **options)
+    config = ServerClusterConfig.read_config(args.c)
+    servers = [start_server(args.c, 0)]
+    time.sleep(0.5)
+    servers.extend(start_server(args.c, uid) for uid in range(1, 2 * args.f + 1))
+    time.sleep(1)
+    # load from the start to the end, the paused master has requests in flight
+    load = subprocess.Popen(["python", "client.py", "-c", str(args.c), "-bench", "closed",
+                             "-concurrency", str(args.concurrency), "-duration", str(24 * 3600)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    durations = []
+    master = probe_master(config, 10 * args.timeout)
+    print("%8s %10s %10s %6s %10s" % ("failover", "old master", "new master", "view", "seconds"))
+    try:
+        for i in range(args.failovers):
+            if master is None:
+                print("no master answers")
+                break
+            os.killpg(servers[master[0]].pid, signal.SIGSTOP)
+            paused_at = time.monotonic()
+            new_master = probe_master(config, 10 * args.timeout)
+            elapsed = time.monotonic() - paused_at
+            # it finds out about the new view when it resumes and follows it
+            os.killpg(servers[master[0]].pid, signal.SIGCONT)
+            if new_master is not None:
+                durations.append(elapsed)
+                print("%8d %10d %10d %6d %10.3f" % (i, master[0], new_master[0], new_master[1], elapsed))
+            master = new_master
+            time.sleep(args.settle)
+    finally:
+        load.kill()
+        load.wait()
+        for server in servers:
+            stop_server(server)
+    if durations:
+        durations.sort()
+        print("failovers %d of %d, p50 %.3f s, p90 %.3f s, max %.3f s" % (
+            len(durations), args.failovers, durations[len(durations) // 2],
+            durations[min(int(0.9 * len(durations)), len(durations) - 1)], durations[-1]))
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
-    generate_config_file(args.c, args.f, args.loss, args.timeout)
+    options = {name: getattr(args, name) for name in CONFIG_OPTIONS}
+    if args.mode == 'bench':
+        bench(args, options)
+        exit()
+    if args.mode == 'failover':
+        failover(args, options)
+        exit()
+    generate_config_file(args.c, args.f, args.loss, args.timeout, **options)
     config = ServerClusterConfig.read_config(args.c)
     for i in range(2 * args.f + 1):
         if i == 0:
@@ -50,5 +294,5 @@ if __name__ == '__main__':
         p.start()
     time.sleep(1)
     for i in range(args.client_n):
-        p = Process(target=run_client, args=(args.c,))
+        p = Process(target=run_client, args=(args.c, i % args.groups))
         p.start()
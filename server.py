@@ -1,63 +1,179 @@
 import argparse
+import os
+import queue
 import random
+import select
+import signal
 import socket
+import threading
+import time
+from collections import deque
 from functools import wraps
 from typing import Type
 from config import ServerClusterConfig
-from multiprocessing import Queue, Process, Manager
+from multiprocessing import Process, Manager, Pipe, current_process
 from message import *
 from error import *
 from server_state import ServerState
+from wal import WriteAheadLog
+from batch import RequestBatcher
+from session import SessionTable
+from ring import RingBuffer
+from failure_detector import PhiAccrualDetector
+from election import Election, next_view, FOLLOWER, LEADER
+from transport import DatagramChannel, MAX_PACKAGE_LENGTH
+from metrics import Metrics
+import codec
+import profiler
 
-MAX_PACKAGE_LENGTH = 4096
-
-
-def follow_new_master_wrapper(func):
-    @wraps(func)
-    def wrap(self, *args, **kwargs):
-        try:
-            func(self, *args, **kwargs)
-        except FollowNewMasterError as e:
-            self.follow_new_master(e.master_uid, e.view_modulo)
-        except DeadMasterError:
-            self.promote_to_master()
-
-    return wrap
+# room left in a YouAreLeader or CatchUp chunk for its other fields, and per proposal for its slot key
+CHUNK_HEADER_SIZE = 512
+CHUNK_ENTRY_OVERHEAD = 16
+# seconds the workers get to write their stack samples before they are merged
+PROFILE_FLUSH_WAIT = 0.2
+# lease renewals per timeout, and the share of the lease the master gives up for the clock drift of the replicas
+LEASE_RENEWALS = 4
+LEASE_DRIFT = 0.1
+# IAmLeader messages a candidate sends to the missing followers within its timeout
+IAM_LEADER_RESENDS = 4
+# the max number of slots in one ReadReply
+MAX_READ_SLOTS = 1000
+# accepted proposals remembered before the delivered ones are dropped
+MAX_PENDING_PROPOSALS = 1024
+# the shortest wait of a replica for a message, so it reads the queued ones once the master is due
+MIN_RECEIVE_TIMEOUT = 0.001
+# (slot, success) records waiting for the reply worker, and the per slot rings of accepting uids created
+# before the dispatcher releases those of the delivered slots
+RESULT_CAPACITY = 4096
+RING_RELEASE_INTERVAL = 256
+# a slot of the result ring which stops the reply worker
+STOP_REPLIES = -1
 
 
 def propose_worker_wrapper(func):
-    def timeout_wrap(self, proposal: Proposal):
-        p = Process(target=func, args=(self, proposal))
-        p.daemon = True
-        p.start()
-        p.join(self.get_default_timeout())
-        if p.is_alive():
-            p.terminate()
-            self.message_queues[proposal.slot].close()
-            self.result_queue.put((proposal, False))
-
     @wraps(func)
     def outer_wrap(self, proposal: Proposal):
-        p = Process(target=timeout_wrap, args=(self, proposal))
+        # the worker stops waiting for the accepts itself and is never killed, a worker killed while it holds
+        # the state lock or the lock of the result ring would block every other one, and a server paused for
+        # longer than the timeout would look hung to any watchdog once it resumes
+        p = Process(target=func, args=(self, proposal), name='propose_worker')
+        p.daemon = True
         p.start()
+        self.proposers[proposal.slot] = p
         # start the worker and move on
 
     return outer_wrap
 
 
 class Server(object):
-    def __init__(self, uid, config: ServerClusterConfig, skip_slots=None):
+    # the state is shared with the forked proposer and learner processes
+    shared_state = True
+
+    def __init__(self, uid, config: ServerClusterConfig, skip_slots=None, group=0):
         self.uid = uid
         self.config = config
+        # the consensus group this server takes part in, every group of a server runs in its own process
+        self.group = group
+        suffix = '_group_%s' % group if config.groups > 1 else ''
+        self.name = 'server_%s%s' % (uid, suffix)
+        self.codec = codec.get_codec(config.codec)
+        # None unless the metrics are enabled, every hook checks it first
+        self.metrics = Metrics() if config.metrics else None
+        # {address: name} of the servers, anything else is counted as a client
+        self.peers = {}
+        for server_uid in range(len(config.servers_config)):
+            ip, port = config.get_address(server_uid, group)
+            self.peers[(ip, port)] = self.peers[(socket.gethostbyname(ip), port)] = 'server-%s' % server_uid
 
-        self.state = ServerState(self.uid, skip_slots=skip_slots)
+        wal = None
+        if config.wal_dir is not None:
+            os.makedirs(config.wal_dir, exist_ok=True)
+            wal = WriteAheadLog(os.path.join(config.wal_dir, 'state_%s%s' % (uid, suffix)),
+                                config.fsync_policy, config.fsync_interval)
+        self.state = ServerState(self.uid, config.initial_master(group), skip_slots=skip_slots,
+                                 shared=self.shared_state, wal=wal, snapshot_interval=config.snapshot_interval,
+                                 retention=config.log_retention, metrics=self.metrics,
+                                 digest_interval=config.digest_interval)
+        # the servers after a suspected master stand for election a heartbeat apart, or a quarter timeout apart
+        self.election = Election(uid, len(config.servers_config), config.heartbeat_interval or config.timeout / 4,
+                                 LEADER if self.state.is_master else FOLLOWER)
+        # the servers which granted the pre-vote of this candidate for pre_vote_modulo
+        self.pre_votes = set()
+        self.pre_vote_modulo = None
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(config.get_address(uid))
+        if config.receive_workers:
+            # the receive workers of the master bind the same address
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(config.get_address(uid, group))
+        # fragments the messages longer than one datagram
+        self.channel = DatagramChannel(self.socket, config.timeout)
 
         self.manager = Manager()
+        # {slot: ring of the uids which accepted it}, only written by the dispatcher and read by the slot's worker
         self.message_queues = {}
-        self.result_queue = self.manager.Queue()
+        self.created_rings = 0
+        # {slot: the worker proposing it}, released with the rings
+        self.proposers = {}
+        # (slot, success) of the finished proposals, the reply worker reads the proposal from the state
+        self.result_queue = RingBuffer('q?', RESULT_CAPACITY, single_writer=False)
+        self.replier = None
+        # the decided proposals the applier process delivers, None if every worker delivers under the lock
+        self.apply_queue = None
+        self.applier = None
+        if config.applier:
+            self.apply_queue = self.manager.Queue()
+
+        # replicas learn from the Commit messages of the master instead of counting accepts
+        self.leader_commit = config.commit_mode == 'leader'
+        # slots accepted by this replica but not acknowledged yet, all of the same master and view
+        self.pending_acks = []
+        self.pending_ack_view = None
+        # set by a view change, every follower delivered the slots below it
+        self.reproposal_slot = 0
+
+        # {replica uid: send time of the latest lease renewal it acknowledged}, only on the master
+        self.lease_acks = {}
+        self.next_lease_renewal = 0.0
+        # a replica follows no other master before this time, it granted the current one a lease until then
+        self.lease_promise = 0.0
+        # the last time a replica heard from its master, and the (slot, arrival time) of the proposals it
+        # accepted in arrival order, so the oldest one not delivered yet tells how far behind the master it is
+        self.master_heard_at = time.monotonic()
+        self.pending_proposals = deque()
+        # the phi accrual detector of a replica while the master sends periodic heartbeats, None with the fixed
+        # timeout, and then the time the heartbeats probing a silent master are given up on, None until they are sent
+        self.failure_detector = None
+        self.probe_deadline = None
+        # the next periodic heartbeat of the master
+        self.next_heartbeat = 0.0
+
+        # the next slot the master announces its digest at
+        self.next_digest_check = config.digest_interval
+        # the slot of the last DigestCheck a replica got from its master
+        self.digest_checked_slot = 0
+
+        self.batcher = None
+        if config.batch_size > 1:
+            self.batcher = RequestBatcher(config.batch_size, config.batch_window, config.batch_bytes)
+
+        # the slots of the recent operations of the master, None if the requests are not deduplicated
+        self.sessions = None
+        if config.dedup_capacity > 0:
+            self.sessions = SessionTable(config.dedup_capacity)
+
+        # (process, decoded connection, outgoing connection) of the receive workers while this server is the master
+        self.receivers = []
+        self.next_receiver = 0
+
+        # the long running workers, told to start and stop profiling by this process
+        self.pid = os.getpid()
+        self.workers = []
+        # when the profiles of the workers are flushed and merged, after profiling stopped
+        self.profile_merge_at = None
+        # SIGUSR1 starts profiling every process of the server, SIGUSR2 stops it, like a ProfileControl
+        signal.signal(signal.SIGUSR1, self.handle_profile_signal)
+        signal.signal(signal.SIGUSR2, self.handle_profile_signal)
 
     def get_f(self):
         return self.config.f
@@ -66,37 +182,222 @@ class Server(object):
         return self.config.timeout
 
     def get_master_address(self):
-        return self.config.get_address(self.state.master_uid)
+        return self.config.get_address(self.state.master_uid, self.group)
 
     def get_addresses(self):
-        return self.config.get_all_replica_ip_port(self_uid=self.uid)
+        return self.config.get_all_replica_ip_port(self_uid=self.uid, group=self.group)
 
     def _send(self, address, byte: bytes):
         if not self.state.is_master and random.uniform(0, 1) < self.config.message_loss:
             # message loss
             return
-        self.socket.sendto(byte, address)
+        self.channel.sendto(byte, address)
+
+    def peer_name(self, address):
+        return self.peers.get(address, 'client')
+
+    def record_sent(self, message: BaseMessage, addresses, size):
+        name = type(message).__name__
+        self.metrics.count('sent.' + name, len(addresses))
+        self.metrics.count('sent_bytes', size * len(addresses))
+        for address in addresses:
+            self.metrics.count('sent_to.' + self.peer_name(address))
+
+    def record_received(self, message: BaseMessage, address, size, decode_time):
+        name = type(message).__name__
+        self.metrics.count('received.' + name)
+        self.metrics.count('received_bytes', size)
+        self.metrics.count('received_from.' + self.peer_name(address))
+        self.metrics.time('decode.' + name, decode_time)
 
     def send_one(self, address, message: BaseMessage):
-        self._send(address, str(message).encode("utf-8"))
+        self.state.sync_log()
+        if self.receivers and os.getpid() == self.pid:
+            # a receive worker encodes and sends it, its bytes are not counted
+            self.next_receiver = (self.next_receiver + 1) % len(self.receivers)
+            self.receivers[self.next_receiver][2].send((address, message))
+            if self.metrics is not None:
+                self.record_sent(message, [address], 0)
+            return
+        msg = self.codec.encode(message, self.group)
+        if self.metrics is not None:
+            self.record_sent(message, [address], len(msg))
+        self._send(address, msg)
 
     def send_all(self, message: BaseMessage):
-        msg = str(message).encode("utf-8")
-        for address in self.get_addresses():
+        self.state.sync_log()
+        msg = self.codec.encode(message, self.group)
+        addresses = self.get_addresses()
+        if self.metrics is not None:
+            self.record_sent(message, addresses, len(msg))
+        for address in addresses:
             self._send(address, msg)
 
+    def decode(self, raw: bytes):
+        return codec.decode(raw)
+
+    def decode_from(self, raw: bytes, address):
+        """
+        :return: the message, None if it belongs to another group
+        """
+        if self.metrics is None:
+            message = self.decode(raw)
+        else:
+            started = time.perf_counter()
+            message = self.decode(raw)
+            self.record_received(message, address, len(raw), time.perf_counter() - started)
+        if message.group != self.group:
+            if self.metrics is not None:
+                self.metrics.count('other_group')
+            return None
+        return message
+
     def _receive_from_socket(self):
-        raw, address = self.socket.recvfrom(MAX_PACKAGE_LENGTH)
-        message = jsonpickle.decode(raw.decode("utf-8"))
-        return message, address
+        while True:
+            raw, address = self.channel.recvfrom()
+            message = self.decode_from(raw, address)
+            if message is not None:
+                return message, address
+
+    def timed_dispatch(self, dispatch, message: BaseMessage, address):
+        if self.metrics is None:
+            dispatch(message, address)
+            return
+        started = time.perf_counter()
+        try:
+            dispatch(message, address)
+        finally:
+            self.metrics.time('dispatch.' + type(message).__name__, time.perf_counter() - started)
+
+    def stats_gauges(self):
+        return {
+            'is_master': self.state.is_master,
+            'master_uid': self.state.master_uid,
+            'view_modulo': self.state.view_modulo,
+            'execute_slot': self.state.execute_slot,
+            'role': self.election.role,
+        }
+
+    def handle_profile_signal(self, signum, frame):
+        self.set_profiling(signum == signal.SIGUSR1)
+
+    def set_profiling(self, enable):
+        # forked workers start sampling with their parent, the long running ones are signalled
+        name = self.name
+        if os.getpid() != self.pid:
+            if enable:
+                profiler.start(self.config.profile_dir, name, current_process().name)
+            else:
+                profiler.stop()
+            return
+        if enable == profiler.is_running():
+            return
+        if enable:
+            profiler.clear(self.config.profile_dir, name)
+            profiler.start(self.config.profile_dir, name, 'main')
+        else:
+            profiler.stop()
+        # the manager of the shared state is not signalled, its requests are sampled in the callers waiting on them
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGUSR1 if enable else signal.SIGUSR2)
+        if enable:
+            self.profile_merge_at = None
+            print("profiling started")
+        else:
+            self.merge_profile_later()
+
+    def merge_profile_later(self):
+        # the dispatcher merges once the workers had the time to write their profiles
+        self.profile_merge_at = time.monotonic() + PROFILE_FLUSH_WAIT
+
+    def merge_profile_left(self):
+        """
+        :return: seconds until the profiles are merged, None if there is nothing to merge
+        """
+        if self.profile_merge_at is None:
+            return None
+        return max(self.profile_merge_at - time.monotonic(), 0.0)
+
+    def merge_profile(self):
+        self.profile_merge_at = None
+        print("profile written to %s" % profiler.merge(self.config.profile_dir, self.name))
+
+    def reply_stats(self, address):
+        stats = ''
+        if self.metrics is not None:
+            stats = self.metrics.to_json(self.stats_gauges())
+        self.send_one(address, StatsReply(self.uid, stats))
 
     def receive(self):
-        return self._receive_from_socket()
+        if not self.receivers:
+            return self._receive_from_socket()
+        # the messages decoded by the receive workers, and those the kernel still gives the socket of this process
+        connections = [decoded for _, decoded, _ in self.receivers]
+        ready, _, _ = select.select(connections + [self.socket], [], [], self.socket.gettimeout())
+        if not ready:
+            raise socket.timeout()
+        if ready[0] is self.socket:
+            return self._receive_from_socket()
+        return self.receive_decoded_message(ready[0])
+
+    def receive_decoded_message(self, decoded):
+        message, address, size, decode_time = decoded.recv()
+        if self.metrics is not None:
+            self.record_received(message, address, size, decode_time)
+        return message, address
 
-    def _receive_with_timeout(self, expecting: Type[BaseMessage] = None):
-        self.socket.settimeout(self.get_default_timeout())
+    def receive_worker(self, decoded, outgoing):
+        # a socket of its own on the address of the master, the kernel spreads the senders over the sockets
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.config.get_address(self.uid, self.group))
+        channel = DatagramChannel(sock, self.config.timeout)
+        # the messages of the master are sent by a thread, so neither process waits on the other while both send
+        threading.Thread(target=self.send_worker, args=(channel, outgoing), daemon=True).start()
+        while True:
+            raw, address = channel.recvfrom()
+            started = time.perf_counter()
+            message = self.decode(raw)
+            if message.group == self.group:
+                # the metrics of this process are never reported, the server records the message once it gets it
+                decoded.send((message, address, len(raw), time.perf_counter() - started))
+
+    def send_worker(self, channel, outgoing):
+        while True:
+            address, message = outgoing.recv()
+            channel.sendto(self.codec.encode(message, self.group), address)
+
+    def start_receivers(self):
+        for _ in range(self.config.receive_workers):
+            decoded, decoded_sender = Pipe(duplex=False)
+            outgoing_receiver, outgoing = Pipe(duplex=False)
+            p = Process(target=self.receive_worker, args=(decoded_sender, outgoing_receiver), name='receive_worker')
+            p.start()
+            decoded_sender.close()
+            outgoing_receiver.close()
+            self.receivers.append((p, decoded, outgoing))
+            self.workers.append(p)
+
+    def stop_receivers(self):
+        # a replica receives everything on its own socket
+        for p, decoded, outgoing in self.receivers:
+            p.terminate()
+            p.join()
+            decoded.close()
+            outgoing.close()
+            self.workers.remove(p)
+        self.receivers = []
+
+    def _receive_with_timeout(self, expecting: Type[BaseMessage] = None, timeout=None):
+        # the other messages received meanwhile do not extend the timeout
+        deadline = time.monotonic() + (self.get_default_timeout() if timeout is None else timeout)
         try:
             while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                self.socket.settimeout(remaining)
                 message, address = self._receive_from_socket()
                 if expecting is None or isinstance(message, expecting):
                     return message, address
@@ -118,60 +419,383 @@ class Server(object):
         self.send_all(proposal)
         message_queue = self.message_queues[proposal.slot]
         accepted_uid = []
+        deadline = time.monotonic() + self.get_default_timeout()
         while len(accepted_uid) < self.get_f():
-            new_uid = message_queue.get()
+            try:
+                new_uid, = message_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.queue_result(proposal.slot, False)
+                return
             if new_uid not in accepted_uid:
                 accepted_uid.append(new_uid)
-        message_queue.close()
-        delivered_proposals = self.state.learn_proposal(proposal)
+        delivered_proposals = self.learn([proposal])
+        if self.leader_commit:
+            self.send_commit([proposal.slot])
         for proposal in delivered_proposals:
-            self.result_queue.put((proposal, True))
+            self.queue_result(proposal.slot, True)
+
+    def queue_result(self, slot, success):
+        # no reply worker reads a full ring after a view change, the client retries instead of the worker hanging
+        try:
+            self.result_queue.put(slot, success, timeout=self.get_default_timeout())
+        except queue.Full:
+            pass
+
+    def learn(self, proposals):
+        """
+        Learn the decided proposals, through the applier if there is one
+        :return: the proposals delivered by this process, none with the applier which queues their replies itself
+        """
+        if self.apply_queue is not None:
+            self.apply_queue.put(proposals)
+            return []
+        delivered_proposals = []
+        for proposal in proposals:
+            delivered_proposals.extend(self.state.learn_proposal(proposal))
+        return delivered_proposals
+
+    def applier_worker(self):
+        # the only process delivering slots while it runs, so it needs no lock, a None stops it
+        # forked with the stale execute slot of the dispatcher, the appliers before this one delivered past it
+        self.state.delivered_watermark()
+        stop = False
+        while not stop:
+            proposals = []
+            batch = self.apply_queue.get()
+            while batch is not None:
+                proposals.extend(batch)
+                # whatever else was decided meanwhile is delivered at once
+                try:
+                    batch = self.apply_queue.get_nowait()
+                except queue.Empty:
+                    break
+            stop = batch is None
+            if proposals:
+                delivered_proposals = self.state.apply_learned(proposals)
+                if self.state.is_master:
+                    for proposal in delivered_proposals:
+                        self.queue_result(proposal.slot, True)
+
+    def start_applier(self):
+        # forked again after every view change, so it knows whether it delivers for a master
+        self.stop_applier()
+        self.applier = Process(target=self.applier_worker, name='applier')
+        self.applier.start()
+        self.workers.append(self.applier)
+
+    def stop_applier(self):
+        # the proposals queued before the stop are still delivered, those queued after wait for the next applier
+        if self.applier is not None:
+            self.apply_queue.put(None)
+            self.applier.join()
+            self.workers.remove(self.applier)
+            self.applier = None
+
+    def send_commit(self, slots):
+        # everything below the execute slot of the master is decided as well
+        commit = Commit(self.uid, self.state.view_modulo, self.state.execute_slot, slots)
+        self.send_all(commit)
+
+    def reply_client(self, proposal: Proposal, success):
+        if isinstance(proposal.operation, OperationBatch):
+            batch = proposal.operation
+            for operation, client_address in zip(batch.operations, batch.client_addresses):
+                self.send_one(client_address, ClientReply(success, operation, self.uid, self.state.view_modulo))
+        elif proposal.client_address is not None:
+            # no-ops filled in by a new master have no client
+            reply = ClientReply(success, proposal.operation, self.uid, self.state.view_modulo)
+            self.send_one(proposal.client_address, reply)
 
     def reply_client_worker(self):
         while True:
-            proposal, success = self.result_queue.get()
-            reply = ClientReply(success, proposal.operation)
-            self.send_one(proposal.client_address, reply)
+            slot, success = self.result_queue.get()
+            if slot == STOP_REPLIES:
+                return
+            if success:
+                proposal = self.state.get_delivered_proposal(slot)
+            else:
+                proposal = self.state.get_accepted_proposal(slot)
+            # compacted or decided meanwhile, the client retries
+            if proposal is not None:
+                self.reply_client(proposal, success)
+            # the one long running process that sees every delivery of the process engine
+            self.send_digest_check()
 
-    def handle_accept(self, accept: Accept):
-        if accept.proposal.slot not in self.message_queues:
-            new_queue = Queue()
-            self.message_queues[accept.proposal.slot] = new_queue
-        queue = self.message_queues[accept.proposal.slot]
+    def stop_replier(self):
+        # the only reader of the result ring, the next master of this server starts a new one
+        if self.replier is not None:
+            self.result_queue.put(STOP_REPLIES, False)
+            self.replier.join()
+            self.workers.remove(self.replier)
+            self.replier = None
+
+    def send_digest_check(self):
+        if self.config.digest_interval <= 0:
+            return
+        # at a multiple of the interval, which a replica ahead of the master still has the digest of
+        slot, digest = self.state.get_interval_digest()
+        if slot >= self.next_digest_check:
+            self.send_all(DigestCheck(self.uid, slot, digest))
+            self.next_digest_check = slot + self.config.digest_interval
+
+    def message_ring(self, slot):
+        # the accepts of a slot can arrive before its proposal, whichever comes first creates the ring
+        ring = self.message_queues.get(slot)
+        if ring is None:
+            ring = self.message_queues[slot] = RingBuffer('q', 2 * len(self.config.servers_config))
+            self.created_rings += 1
+            if self.created_rings % RING_RELEASE_INTERVAL == 0:
+                self.release_message_rings()
+        return ring
+
+    def release_message_rings(self):
+        # the workers of the delivered slots are done, the forked ones keep their own mapping of a ring anyway
+        watermark = self.state.delivered_watermark()
+        for slot in [slot for slot in self.message_queues if slot < watermark]:
+            self.message_queues.pop(slot).close()
+        for slot in [slot for slot in self.proposers if slot < watermark]:
+            del self.proposers[slot]
+
+    def drop_message_rings(self):
+        # the workers of the previous view keep their own rings, so none of them counts an accept of the new view
+        for ring in self.message_queues.values():
+            ring.close()
+        self.message_queues = {}
+        self.proposers = {}
+
+    def in_current_view(self, master_uid, view_modulo):
+        return master_uid == self.state.master_uid and view_modulo == self.state.view_modulo
+
+    def count_accept(self, slot, uid):
+        # a late accept of a delivered slot, the execute slot of this process is behind if anything
+        if slot < self.state.execute_slot:
+            return
         try:
-            queue.put(accept.uid)
-        except:
+            self.message_ring(slot).put_nowait(uid)
+        except queue.Full:
+            # duplicates the worker has not read yet, or a finished worker
             pass
 
+    def handle_accept(self, accept: Accept):
+        self.count_accept(accept.proposal.slot, accept.uid)
+
+    def handle_accept_range(self, accept_range: AcceptRange):
+        for slot in range(accept_range.start_slot, accept_range.end_slot):
+            self.count_accept(slot, accept_range.uid)
+
     def reply_heartbeat(self, address):
         heartbeat = HeartBeat(self.uid, need_reply=False)
         self.send_one(address, heartbeat)
 
+    def renew_lease(self):
+        """
+        Send a lease renewal when it is due, the replicas which acknowledge it follow no other master for a timeout
+        :return: seconds until the next renewal
+        """
+        now = time.monotonic()
+        if now >= self.next_lease_renewal:
+            self.send_all(HeartBeat(self.uid, need_reply=True, sent_at=now))
+            self.next_lease_renewal = now + self.get_default_timeout() / LEASE_RENEWALS
+        return self.next_lease_renewal - now
+
+    def send_heartbeat(self):
+        """
+        Send the replicas a heartbeat when it is due, so they hear from the master while it has nothing to propose
+        :return: seconds until the next heartbeat
+        """
+        now = time.monotonic()
+        if now >= self.next_heartbeat:
+            self.send_all(HeartBeat(self.uid, need_reply=False))
+            self.next_heartbeat = now + self.config.heartbeat_interval
+        return self.next_heartbeat - now
+
+    def handle_lease_ack(self, heartbeat: HeartBeat):
+        if heartbeat.sent_at > self.lease_acks.get(heartbeat.uid, 0.0):
+            self.lease_acks[heartbeat.uid] = heartbeat.sent_at
+
+    def lease_renewed_at(self):
+        # the latest renewal f replicas acknowledged, None before that
+        if len(self.lease_acks) < self.get_f():
+            return None
+        return sorted(self.lease_acks.values(), reverse=True)[self.get_f() - 1]
+
+    def has_lease(self):
+        # counted from the send time of the renewals, so the lease ends before the promise of any replica
+        renewed_at = self.lease_renewed_at()
+        if not self.config.read_lease or renewed_at is None:
+            return False
+        return time.monotonic() < renewed_at + self.get_default_timeout() * (1 - LEASE_DRIFT)
+
+    def oldest_pending_proposal(self):
+        # the arrival time of the first accepted proposal which is not delivered, None if there is none
+        watermark = self.state.delivered_watermark()
+        while self.pending_proposals and self.pending_proposals[0][0] < watermark:
+            self.pending_proposals.popleft()
+        return self.pending_proposals[0][1] if self.pending_proposals else None
+
+    def staleness(self):
+        """
+        Seconds since this server last delivered everything its master decided
+            master: 0 under its lease, else since the last renewal f replicas acknowledged
+            replica: since the oldest accepted proposal it did not deliver arrived, or since it heard from the master
+        """
+        now = time.monotonic()
+        if self.state.is_master:
+            if self.has_lease():
+                return 0.0
+            renewed_at = self.lease_renewed_at()
+            return float('inf') if renewed_at is None else now - renewed_at
+        oldest = self.oldest_pending_proposal()
+        return now - (self.master_heard_at if oldest is None else oldest)
+
+    def handle_read_request(self, message: ReadRequest, client_address):
+        staleness = self.staleness()
+        watermark = self.state.delivered_watermark()
+        if staleness > message.max_staleness or watermark < message.min_slot:
+            # a replica leaves the reads without staleness to the master
+            if self.state.is_master or message.max_staleness:
+                self.send_one(client_address, ReadReply(message.uid, False, watermark=watermark, staleness=staleness,
+                                                        master_uid=self.state.master_uid,
+                                                        view_modulo=self.state.view_modulo))
+            return
+        start_slot, end_slot, delivered = self.state.read_delivered(message.start_slot,
+                                                                    min(message.limit, MAX_READ_SLOTS))
+        operations = {slot: proposal.operation for slot, proposal in delivered.items()
+                      if not proposal.operation.if_nop()}
+        self.send_one(client_address, ReadReply(message.uid, True, start_slot, end_slot, operations,
+                                                watermark, staleness, self.state.master_uid, self.state.view_modulo))
+
+    def handle_duplicate(self, operation: Operation, client_address):
+        """
+        Answer a retried request of an operation in the session table
+        :return: False if the operation is new and should be proposed
+        """
+        entry = self.sessions.get(operation.uid)
+        if entry is None:
+            self.sessions.add(operation.uid)
+            return False
+        slot, proposed_at = entry
+        if slot is not None and self.state.is_delivered(slot, operation.uid):
+            # the reply was lost, send it again
+            self.send_one(client_address, ClientReply(True, operation, self.uid, self.state.view_modulo))
+            outcome = 'answered'
+        elif slot is not None and time.monotonic() - proposed_at > self.get_default_timeout():
+            # the proposal timed out, the operation is only ever decided in its own slot
+            self.sessions.add(operation.uid, slot)
+            self.repropose(slot)
+            outcome = 'reproposed'
+        else:
+            # still in flight, the reply is on its way
+            outcome = 'dropped'
+        if self.metrics is not None:
+            self.metrics.count('duplicate.' + outcome)
+        return True
+
+    def repropose(self, slot):
+        proposal = self.state.get_accepted_proposal(slot)
+        worker = self.proposers.get(slot)
+        if proposal is not None and (worker is None or not worker.is_alive()):
+            # the accepts of the previous attempt are dropped with its ring, a worker still waiting on it keeps it
+            ring = self.message_queues.pop(slot, None)
+            if ring is not None:
+                ring.close()
+            self.message_ring(slot)
+            self.propose_worker(proposal)
+
     def handle_client_request(self, message: ClientRequest, client_address):
-        proposal = self.state.propose_operation(message.operation, client_address)
-        # create new queue
-        if proposal.slot not in self.message_queues:
-            new_queue = Queue()
-            self.message_queues[proposal.slot] = new_queue
+        if self.sessions is not None and self.handle_duplicate(message.operation, client_address):
+            return
+        if self.batcher is None:
+            self.propose(message.operation, client_address)
+        elif self.batcher.add(message.operation, client_address):
+            self.flush_batch()
+
+    def flush_batch(self):
+        batch = self.batcher.flush()
+        if batch is not None:
+            # the client addresses are in the batch
+            self.propose(batch, None)
+
+    def assign_slot(self, operation, client_address):
+        proposal = self.state.propose_operation(operation, client_address)
+        if self.sessions is not None:
+            self.sessions.assign(proposal)
+        return proposal
+
+    def propose(self, operation, client_address):
+        proposal = self.assign_slot(operation, client_address)
+        self.message_ring(proposal.slot)
         self.propose_worker(proposal)
 
+    def dispatch_master_message(self, message: BaseMessage, address):
+        if isinstance(message, ClientRequest):
+            # print("get client request")
+            self.handle_client_request(message, address)
+        elif isinstance(message, Accept):
+            if self.in_current_view(message.proposal.master_uid, message.proposal.view_modulo):
+                self.handle_accept(message)
+        elif isinstance(message, AcceptRange):
+            if self.in_current_view(message.master_uid, message.view_modulo):
+                self.handle_accept_range(message)
+        elif isinstance(message, ReadRequest):
+            self.handle_read_request(message, address)
+        elif isinstance(message, HeartBeat):
+            if message.need_reply:
+                self.reply_heartbeat(address)
+            elif message.sent_at:
+                self.handle_lease_ack(message)
+        elif isinstance(message, StatsRequest):
+            self.reply_stats(address)
+        elif isinstance(message, ProfileControl):
+            self.set_profiling(message.enable)
+        elif isinstance(message, PreVoteRequest):
+            self.reply_pre_vote(message, address)
+        elif isinstance(message, IAmLeader):
+            if self.can_follow_new_leader(message.uid, message.view_modulo):
+                # a later view was elected while this master was cut off
+                raise FollowNewMasterError(message.uid, message.view_modulo, message.execute_slot)
+        elif isinstance(message, YouAreLeader):
+            # the f followers of the view change get every slot from reproposal_slot on proposed again,
+            # the chunks of those joining later arrive here, once per follow or per request of a lagging follower
+            if message.view_modulo == self.state.view_modulo and message.chunk == message.chunks - 1:
+                self.catch_up(message.follower_uid, message.execute_slot)
+        elif isinstance(message, (Proposal, Commit, CatchUp)):
+            if self.can_follow_new_leader(message.master_uid, message.view_modulo):
+                # the IAmLeader of the later view was lost, its proposals show it just as well
+                raise FollowNewMasterError(message.master_uid, message.view_modulo)
+        # ignore all other messages
+
     def master_dispatcher(self):
         while True:
-            message, address = self.receive()
-            if isinstance(message, ClientRequest):
-                # print("get client request")
-                self.handle_client_request(message, address)
-            elif isinstance(message, Accept):
-                if message.proposal.master_uid == self.uid:
-                    self.handle_accept(message)
-            elif isinstance(message, HeartBeat):
-                if message.need_reply:
-                    self.reply_heartbeat(address)
-            # ignore all other messages
+            time_left = None
+            if self.batcher is not None:
+                time_left = self.batcher.time_left()
+                if time_left == 0:
+                    self.flush_batch()
+                    time_left = None
+            if self.config.read_lease:
+                renewal_left = self.renew_lease()
+                time_left = renewal_left if time_left is None else min(time_left, renewal_left)
+            if self.config.heartbeat_interval > 0:
+                heartbeat_left = self.send_heartbeat()
+                time_left = heartbeat_left if time_left is None else min(time_left, heartbeat_left)
+            merge_left = self.merge_profile_left()
+            if merge_left == 0:
+                self.merge_profile()
+            elif merge_left is not None:
+                time_left = merge_left if time_left is None else min(time_left, merge_left)
+            # wake up when the batch window closes, the lease, the heartbeat or the profile merge is due
+            self.socket.settimeout(time_left)
+            try:
+                message, address = self.receive()
+            except socket.timeout:
+                continue
+            self.timed_dispatch(self.dispatch_master_message, message, address)
 
     def master_main(self):
-        p = Process(target=self.reply_client_worker)
-        p.start()
+        self.replier = Process(target=self.reply_client_worker, name='reply_client_worker')
+        self.replier.start()
+        self.workers.append(self.replier)
         self.master_dispatcher()
 
     def replica_learner(self, proposal: Proposal):
@@ -179,44 +803,180 @@ class Server(object):
         accepted_uid = []
         # with the proposal and self, it only need f-1 other accept messages
         while len(accepted_uid) < self.get_f() - 1:
-            new_uid = message_queue.get()
+            new_uid, = message_queue.get()
             if new_uid not in accepted_uid:
                 accepted_uid.append(new_uid)
-        message_queue.close()
-        self.state.learn_proposal(proposal)
+        self.learn([proposal])
+
+    def start_learner(self, proposal: Proposal):
+        self.message_ring(proposal.slot)
+        p = Process(target=self.replica_learner, args=(proposal,), name='replica_learner')
+        p.start()
 
     def handle_proposal(self, proposal: Proposal):
         if self.state.master_uid == proposal.master_uid:
             if self.state.accept_proposal(proposal):
+                self.pending_proposals.append((proposal.slot, time.monotonic()))
+                if len(self.pending_proposals) > MAX_PENDING_PROPOSALS:
+                    self.oldest_pending_proposal()
                 accept_message = Accept(self.uid, proposal)
-                self.send_all(accept_message)
-                if proposal.slot not in self.message_queues:
-                    self.message_queues[proposal.slot] = Queue()
-                p = Process(target=self.replica_learner, args=(proposal,))
-                p.start()
+                if self.config.range_ack:
+                    self.ack_later(proposal)
+                elif self.leader_commit:
+                    # only the master counts the accepts, the decision comes back as a Commit
+                    self.send_one(self.get_master_address(), accept_message)
+                else:
+                    self.send_all(accept_message)
+                    self.start_learner(proposal)
+
+    def ack_later(self, proposal: Proposal):
+        view = (proposal.master_uid, proposal.view_modulo)
+        if view != self.pending_ack_view:
+            self.flush_acks()
+            self.pending_ack_view = view
+        self.pending_acks.append(proposal.slot)
+
+    def flush_acks(self):
+        if not self.pending_acks:
+            return
+        master_uid, view_modulo = self.pending_ack_view
+        slots = sorted(self.pending_acks)
+        start = slots[0]
+        # one AcceptRange per run of consecutive slots
+        for previous, slot in zip(slots, slots[1:] + [None]):
+            if slot != previous + 1:
+                accept_range = AcceptRange(self.uid, master_uid, view_modulo, start, previous + 1)
+                self.send_one(self.config.get_address(master_uid, self.group), accept_range)
+                start = slot
+        self.pending_acks = []
+
+    def handle_digest_check(self, digest_check: DigestCheck):
+        if self.state.master_uid == digest_check.uid:
+            self.state.check_digest(digest_check.slot, digest_check.digest)
+            watermark = self.state.delivered_watermark()
+            if watermark < self.digest_checked_slot:
+                # still short of the slot the master checked an interval ago, a lost proposal left a gap
+                self.send_one(self.get_master_address(),
+                              YouAreLeader(self.uid, {}, view_modulo=self.state.view_modulo, execute_slot=watermark))
+            self.digest_checked_slot = digest_check.slot
+
+    def handle_commit(self, commit: Commit):
+        if self.state.master_uid != commit.master_uid:
+            return
+        if self.apply_queue is None:
+            self.state.learn_committed(commit.master_uid, commit.view_modulo, commit.commit_slot, commit.slots)
+        else:
+            self.learn(self.state.get_committed(commit.master_uid, commit.view_modulo, commit.commit_slot, commit.slots))
+
+    def master_heard(self, message: BaseMessage):
+        now = time.monotonic()
+        self.master_heard_at = now
+        self.probe_deadline = None
+        if self.failure_detector is not None:
+            if isinstance(message, HeartBeat) and not message.need_reply:
+                self.failure_detector.heartbeat(now)
+            else:
+                self.failure_detector.heard(now)
+
+    def suspicion_deadline(self):
+        # the time the master is suspected unless it is heard from before
+        if self.failure_detector is not None:
+            return self.failure_detector.suspected_at()
+        if self.probe_deadline is not None:
+            return self.probe_deadline
+        return self.master_heard_at + self.get_default_timeout()
 
     def check_master_alive(self, retry=3):
-        if self.uid == self.state.master_uid:
-            # check master alive is only called by replica, this is cause by failed promotion
-            # should be considered the same as the master is dead
-            return False
+        """
+        Raise DeadMasterError once the master is suspected. With the fixed timeout a silent master is probed
+        with heartbeats first, the replica keeps dispatching meanwhile and any message of the master clears it.
+        """
+        if time.monotonic() < self.suspicion_deadline():
+            return
+        if select.select([self.socket], [], [], 0)[0]:
+            # messages are still queued, the master may be among them
+            return
+        # check master alive is only called by replica, a master uid of this server is caused by a failed promotion
+        # and should be considered the same as the master is dead
+        if self.failure_detector is not None or self.probe_deadline is not None or self.uid == self.state.master_uid:
+            raise DeadMasterError()
         # because of message loss, need multiple heartbeat
         for _ in range(retry):
             heartbeat = HeartBeat(self.uid, need_reply=True)
             self.send_one(self.get_master_address(), heartbeat)
-        try:
-            self._receive_with_timeout(HeartBeat)
-        except socket.timeout:
-            return False
-        return True
+        self.probe_deadline = time.monotonic() + self.get_default_timeout()
 
     def can_follow_new_leader(self, new_master_uid, new_master_view_modulo):
-        return new_master_uid > self.state.master_uid or new_master_view_modulo > self.state.view_modulo
+        # a later view has a higher view modulo, or the same one and a higher master uid
+        return (new_master_view_modulo, new_master_uid) > (self.state.view_modulo, self.state.master_uid)
+
+    def quiet_period(self):
+        # the silence of the master after which this server grants a pre-vote, well before it suspects the master
+        if self.failure_detector is not None:
+            return self.failure_detector.suspicion_timeout() / 2
+        return self.get_default_timeout()
+
+    def reply_pre_vote(self, request: PreVoteRequest, address):
+        # a live master refuses, so does a replica which heard from it lately or promised it a lease
+        now = time.monotonic()
+        granted = not self.state.is_master and self.can_follow_new_leader(request.uid, request.view_modulo) and \
+            now >= self.lease_promise and now - self.master_heard_at >= self.quiet_period()
+        if granted:
+            # the candidate is given a step to win before this server stands itself
+            self.election.hold(now)
+        self.send_one(address, PreVoteReply(self.uid, request.view_modulo, granted))
+
+    def handle_pre_vote_reply(self, reply: PreVoteReply):
+        if reply.granted and reply.view_modulo == self.pre_vote_modulo:
+            self.pre_votes.add(reply.uid)
+
+    def wait_for_election(self, deadline, done=None):
+        """
+        Dispatch like a replica until the deadline, and the pre-votes granted meanwhile, or until done
+        :return: False if the master was heard from meanwhile
+        """
+        while done is None or not done():
+            remaining = max(deadline, self.election.hold_until) - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                message, address = self._receive_with_timeout(timeout=remaining)
+            except socket.timeout:
+                break
+            # an IAmLeader of a server which stood first is followed
+            self.timed_dispatch(self.dispatch_replica_message, message, address)
+            if self.is_from_master(message):
+                self.master_heard(message)
+                return False
+        return True
+
+    def campaign(self):
+        """
+        Stand for election once the master is suspected: wait for the servers ranked before this one, win the
+        pre-vote of f other servers which lost the master as well, then run the view change
+        """
+        if not self.wait_for_election(time.monotonic() + self.election.backoff(self.state.master_uid)):
+            self.election.follow()
+            return
+        view_modulo, _ = next_view(self.uid, self.state.view_modulo, self.state.master_uid)
+        self.pre_votes = set()
+        self.pre_vote_modulo = view_modulo
+        self.send_all(PreVoteRequest(self.uid, view_modulo))
+        if not self.wait_for_election(time.monotonic() + self.get_default_timeout(),
+                                      lambda: len(self.pre_votes) >= self.get_f()):
+            self.election.follow()
+        elif len(self.pre_votes) >= self.get_f() and self.promote_to_master():
+            self.election.won()
+        else:
+            print("election lost")
+            self.election.lost()
 
     def propose_any_learned_operations(self):
-        all_learned_proposals = self.state.get_all_learned_proposals()
+        # every follower delivered the slots below reproposal_slot, only the suffix is proposed again
+        start_slot = max(self.reproposal_slot, self.state.checkpoint_slot)
+        all_learned_proposals = self.state.get_learned_proposals_from(start_slot)
         # fill in no-ops
-        slot = 0
+        slot = start_slot
         while len(all_learned_proposals):
             if slot in all_learned_proposals:
                 all_learned_proposals.pop(slot)
@@ -225,88 +985,278 @@ class Server(object):
                 proposal = Proposal(self.uid, self.state.view_modulo, None, slot, Operation())
                 self.state.learn_proposal(proposal)
             slot += 1
-        all_learned_proposals = self.state.get_all_learned_proposals()
-        # print("here, ", all_learned_proposals)
+        all_learned_proposals = self.state.get_learned_proposals_from(start_slot)
         for proposal in all_learned_proposals.values():
-            self.send_all(proposal)
+            # in the new view, so a replica which accepted the slot from the old master replaces it
+            self.send_all(Proposal(self.uid, self.state.view_modulo, proposal.client_address,
+                                   proposal.slot, proposal.operation))
+        if self.leader_commit and all_learned_proposals:
+            self.send_commit(list(all_learned_proposals.keys()))
 
     def promote_to_master(self):
-        if self.uid < self.state.master_uid:
-            self.state.update_master_state(self.uid, self.state.view_modulo + 1)
-        else:
-            self.state.update_master_state(self.uid)
-        leader_message = IAmLeader(self.uid, self.state.view_modulo)
+        """
+        The view change of a candidate, which collects the logs of f followers within a timeout
+        :return: whether this server is the master now
+        """
+        # the view change reads and resets the log, nothing else delivers meanwhile
+        self.stop_applier()
+        self.state.update_master_state(self.uid, next_view(self.uid, self.state.view_modulo, self.state.master_uid)[0])
+        self.drop_message_rings()
+        watermark = self.state.get_watermark()
+        leader_message = IAmLeader(self.uid, self.state.view_modulo, watermark)
         self.send_all(leader_message)
         learned_message = {}
+        checkpoint = (0, b'')
         follow_uid = []
+        # {follower_uid: (chunks, {chunk: learned})} until every chunk of a follower arrived
+        chunks = {}
+        reproposal_slot = watermark
+        # the other messages received meanwhile do not extend the view change
+        deadline = time.monotonic() + self.get_default_timeout()
+        resend_interval = self.get_default_timeout() / IAM_LEADER_RESENDS
+        resend_at = time.monotonic() + resend_interval
         while len(follow_uid) < self.get_f():
+            if time.monotonic() >= resend_at:
+                # an IAmLeader or a chunk was lost, a follower missing sends all of its chunks again
+                for uid in range(len(self.config.servers_config)):
+                    if uid != self.uid and uid not in follow_uid:
+                        self.send_one(self.config.get_address(uid, self.group), leader_message)
+                resend_at += resend_interval
             try:
-                while True:
-                    message, _ = self._receive_with_timeout()
-                    if isinstance(message, YouAreLeader):
-                        break
-                    elif isinstance(message, IAmLeader):
-                        if self.can_follow_new_leader(message.uid, message.view_modulo):
-                            self.follow_new_master(message.uid, message.view_modulo)
+                message, _ = self._receive_with_timeout(timeout=min(deadline, resend_at) - time.monotonic())
             except socket.timeout:
+                if time.monotonic() < deadline:
+                    continue
                 print("promote to master failed")
                 self.state.is_master = False
-                self.main()
-                exit()
-            if message.follower_uid not in follow_uid:
-                print("get a follower ", message.follower_uid)
+                return False
+            if isinstance(message, IAmLeader):
+                if self.can_follow_new_leader(message.uid, message.view_modulo):
+                    raise FollowNewMasterError(message.uid, message.view_modulo, message.execute_slot)
+                continue
+            if not isinstance(message, YouAreLeader):
+                continue
+            if message.follower_uid in follow_uid or message.view_modulo != self.state.view_modulo:
+                continue
+            count, received = chunks.get(message.follower_uid, (None, None))
+            if count != message.chunks:
+                # sent again after the follower learned more, the chunks of the first split do not fit in
+                received = {}
+                chunks[message.follower_uid] = (message.chunks, received)
+            received[message.chunk] = message.learned
+            if len(received) < message.chunks:
+                continue
+            print("get a follower ", message.follower_uid)
+            follow_uid.append(message.follower_uid)
+            for learned in received.values():
                 # json do not allow int key
-                new_learned = {}
-                for slot in message.learned:
-                    new_learned[int(slot)] = message.learned[slot]
-                follow_uid.append(message.follower_uid)
-                learned_message.update(new_learned)
+                for slot in learned:
+                    learned_message[int(slot)] = learned[slot]
+            if message.checkpoint_slot > checkpoint[0]:
+                checkpoint = (message.checkpoint_slot, message.checkpoint_hash)
+            reproposal_slot = min(reproposal_slot, message.execute_slot)
         # become master
+        self.state.adopt_checkpoint(*checkpoint)
         self.state.update_new_state(learned_message)
-        self.main()
-        return
+        self.reproposal_slot = reproposal_slot
+        return True
+
+    def split_learned(self, learned):
+        # chunks of learned proposals, each of which fits in one YouAreLeader or CatchUp datagram
+        chunks = [{}]
+        size = 0
+        for slot in sorted(learned):
+            proposal_size = len(self.codec.encode(learned[slot])) + CHUNK_ENTRY_OVERHEAD
+            if chunks[-1] and size + proposal_size > MAX_PACKAGE_LENGTH - CHUNK_HEADER_SIZE:
+                chunks.append({})
+                size = 0
+            chunks[-1][slot] = learned[slot]
+            size += proposal_size
+        return chunks
 
-    def follow_new_master(self, master_uid, view_modulo):
+    def follow_new_master(self, master_uid, view_modulo, execute_slot=0):
         print("current master %s, view %s." % (self.state.master_uid, self.state.view_modulo),
               " following new master %s, view %s" % (master_uid, view_modulo))
         print()
+        self.stop_applier()
+        self.stop_replier()
+        self.stop_receivers()
+        self.election.follow()
         self.state.update_master_state(master_uid, view_modulo)
-        learned_proposals = self.state.get_all_learned_proposals()
-        you_are_leader = YouAreLeader(self.uid, learned_proposals)
-        self.send_one(self.config.get_address(master_uid), you_are_leader)
-        # time.sleep(self.get_default_timeout())
-        self.main()
+        self.drop_message_rings()
+        self.master_heard_at = time.monotonic()
+        self.digest_checked_slot = 0
+        self.send_you_are_leader(master_uid, view_modulo, execute_slot)
+
+    def send_you_are_leader(self, master_uid, view_modulo, execute_slot):
+        # the new master delivered every slot below its execute_slot already
+        chunks = self.split_learned(self.state.get_learned_proposals_from(execute_slot))
+        watermark = self.state.get_watermark()
+        for i, learned in enumerate(chunks):
+            you_are_leader = YouAreLeader(self.uid, learned, self.state.checkpoint_slot, self.state.checkpoint_hash,
+                                          view_modulo, watermark, i, len(chunks))
+            self.send_one(self.config.get_address(master_uid, self.group), you_are_leader)
+
+    def catch_up(self, follower_uid, watermark):
+        """
+        Send a follower which joined this view after the view change the slots it missed, it rejected the
+        proposals of this view until then and it may lag below reproposal_slot
+        """
+        end_slot = self.state.delivered_watermark()
+        _, _, learned = self.state.read_delivered(watermark, end_slot - watermark)
+        if not learned and watermark >= self.state.checkpoint_slot:
+            return
+        address = self.config.get_address(follower_uid, self.group)
+        for chunk in self.split_learned(learned):
+            self.send_one(address, CatchUp(self.uid, self.state.view_modulo, chunk,
+                                           self.state.checkpoint_slot, self.state.checkpoint_hash))
+
+    def handle_catch_up(self, catch_up: CatchUp):
+        # the slots compacted by the master cannot be sent any more
+        self.state.adopt_checkpoint(catch_up.checkpoint_slot, catch_up.checkpoint_hash)
+        watermark = self.state.delivered_watermark()
+        # json do not allow int key
+        learned = {int(slot): proposal for slot, proposal in catch_up.learned.items()}
+        self.learn([learned[slot] for slot in sorted(learned) if slot >= watermark])
+
+    def is_from_master(self, message):
+        if isinstance(message, (Proposal, Commit, CatchUp)):
+            return message.master_uid == self.state.master_uid
+        if isinstance(message, (HeartBeat, DigestCheck)):
+            return message.uid == self.state.master_uid
+        return False
+
+    def dispatch_replica_message(self, message: BaseMessage, address):
+        if isinstance(message, (Proposal, Commit, CatchUp)) and \
+                self.can_follow_new_leader(message.master_uid, message.view_modulo):
+            # the IAmLeader of the later view was lost, its proposals show it just as well
+            raise FollowNewMasterError(message.master_uid, message.view_modulo)
+        if isinstance(message, Proposal):
+            self.handle_proposal(message)
+        elif isinstance(message, Accept):
+            if self.in_current_view(message.proposal.master_uid, message.proposal.view_modulo):
+                self.handle_accept(message)
+        elif isinstance(message, Commit):
+            self.handle_commit(message)
+        elif isinstance(message, DigestCheck):
+            self.handle_digest_check(message)
+        elif isinstance(message, HeartBeat):
+            if message.need_reply and message.uid == self.state.master_uid:
+                self.grant_lease(message, address)
+        elif isinstance(message, ReadRequest):
+            self.handle_read_request(message, address)
+        elif isinstance(message, StatsRequest):
+            self.reply_stats(address)
+        elif isinstance(message, ProfileControl):
+            self.set_profiling(message.enable)
+        elif isinstance(message, IAmLeader):
+            if self.can_follow_new_leader(message.uid, message.view_modulo) and time.monotonic() >= self.lease_promise:
+                raise FollowNewMasterError(message.uid, message.view_modulo, message.execute_slot)
+            if self.in_current_view(message.uid, message.view_modulo):
+                # the candidate is still missing chunks of this follower
+                self.send_you_are_leader(message.uid, message.view_modulo, message.execute_slot)
+        elif isinstance(message, CatchUp):
+            if self.in_current_view(message.master_uid, message.view_modulo):
+                self.handle_catch_up(message)
+        elif isinstance(message, PreVoteRequest):
+            self.reply_pre_vote(message, address)
+        elif isinstance(message, PreVoteReply):
+            self.handle_pre_vote_reply(message)
+
+    def grant_lease(self, heartbeat: HeartBeat, address):
+        if heartbeat.sent_at:
+            self.lease_promise = time.monotonic() + self.get_default_timeout()
+        self.send_one(address, HeartBeat(self.uid, need_reply=False, sent_at=heartbeat.sent_at))
+
+    def start_failure_detector(self):
+        # the silence of the master goes on across a lost election, it only starts over with a new master
+        self.probe_deadline = None
+        self.failure_detector = None
+        interval = self.config.heartbeat_interval
+        if interval > 0:
+            # a lost heartbeat doubles the interval, the pause and the min deviation cover it
+            self.failure_detector = PhiAccrualDetector(self.config.phi_threshold, interval, interval, interval / 4,
+                                                       self.get_default_timeout(), self.master_heard_at)
 
     def replica_dispatcher(self):
+        # only the messages of the master show it is alive, clients keep sending to a dead one
+        self.start_failure_detector()
         while True:
+            timeout = self.suspicion_deadline() - time.monotonic()
+            sync_left = self.state.sync_log_left()
+            if sync_left is not None:
+                timeout = min(timeout, sync_left)
+            merge_left = self.merge_profile_left()
+            if merge_left == 0:
+                self.merge_profile()
+            elif merge_left is not None:
+                timeout = min(timeout, merge_left)
             try:
-                message, address = self._receive_with_timeout()
+                message, address = self._receive_with_timeout(timeout=max(timeout, MIN_RECEIVE_TIMEOUT))
             except socket.timeout:
-                if self.check_master_alive():
-                    continue
-                else:
-                    raise DeadMasterError()
-            if isinstance(message, Proposal):
-                self.handle_proposal(message)
-            if isinstance(message, Accept):
-                self.handle_accept(message)
-            if isinstance(message, IAmLeader):
-                if self.can_follow_new_leader(message.uid, message.view_modulo):
-                    raise FollowNewMasterError(message.uid, message.view_modulo)
+                message = None
+            if self.state.sync_log_left() == 0:
+                # the interval fsync of the records accepted before an idle period
+                self.state.sync_log()
+            if self.is_from_master(message):
+                self.master_heard(message)
+            if message is not None:
+                self.timed_dispatch(self.dispatch_replica_message, message, address)
+            # after the message, which may be the IAmLeader of the next master
+            if not self.is_from_master(message):
+                self.check_master_alive()
+            if self.pending_acks and not select.select([self.socket], [], [], 0)[0]:
+                # nothing else is queued, acknowledge everything accepted so far
+                self.flush_acks()
 
     def replica_main(self):
         self.replica_dispatcher()
 
-    @follow_new_master_wrapper
     def main(self):
-        if self.state.is_master:
-            print("master")
-            self.propose_any_learned_operations()
-            self.master_main()
-        else:
-            print("replica")
-            print("current master %s, view %s " % (self.state.master_uid, self.state.view_modulo))
-            self.replica_main()
+        # the election state machine, a view change comes back here instead of entering main again
+        while True:
+            try:
+                if self.election.role == LEADER:
+                    self.lead()
+                elif self.election.role == FOLLOWER:
+                    self.follow()
+                else:
+                    self.campaign()
+            except FollowNewMasterError as e:
+                self.follow_new_master(e.master_uid, e.view_modulo, e.execute_slot)
+            except DeadMasterError:
+                self.election.stand()
+
+    def lead(self):
+        print("master")
+        # granted to an earlier view of this server
+        self.lease_acks = {}
+        self.propose_any_learned_operations()
+        if self.sessions is not None:
+            # the slots only accepted in the previous view are empty again
+            start_slot = max(self.state.get_watermark() - self.config.dedup_capacity, 0)
+            self.sessions.rebuild(self.state.get_learned_proposals_from(start_slot))
+        if self.apply_queue is not None:
+            self.start_applier()
+        if self.config.receive_workers:
+            self.start_receivers()
+        self.master_main()
+
+    def follow(self):
+        print("replica")
+        print("current master %s, view %s " % (self.state.master_uid, self.state.view_modulo))
+        if self.apply_queue is not None:
+            self.start_applier()
+        self.replica_main()
+
+
+def run_group(config: ServerClusterConfig, uid, skip_slots=None, group=0):
+    if config.engine == 'asyncio':
+        from async_server import AsyncServer
+        server = AsyncServer(uid, config, skip_slots=skip_slots, group=group)
+    else:
+        server = Server(uid, config, skip_slots=skip_slots, group=group)
+    server.main()
 
 
 parser = argparse.ArgumentParser(description='Start a new client')
@@ -322,5 +1272,21 @@ if __name__ == '__main__':
     if args.skip_slots is not None:
         args.skip_slots = args.skip_slots.split(',')
         args.skip_slots = [int(slot) for slot in args.skip_slots]
-    server = Server(args.uid, config, skip_slots=args.skip_slots)
-    server.main()
+    if config.groups == 1:
+        run_group(config, args.uid, args.skip_slots)
+        exit()
+    # one process per group, the skip slots are only for group 0
+    groups = [Process(target=run_group, args=(config, args.uid, args.skip_slots if group == 0 else None, group),
+                      name='group_%s' % group) for group in range(config.groups)]
+    for p in groups:
+        p.start()
+
+    def forward_signal(signum, frame):
+        # kill -USR1 <pid> profiles every group
+        for p in groups:
+            os.kill(p.pid, signum)
+
+    signal.signal(signal.SIGUSR1, forward_signal)
+    signal.signal(signal.SIGUSR2, forward_signal)
+    for p in groups:
+        p.join()
@@ -1,19 +1,36 @@
 import sys
+import itertools
 import jsonpickle
 import hashlib
+import threading
+import time
 from multiprocessing import Manager
 
 from functools import wraps
-from message import Operation, Proposal
+from message import Operation, Proposal, IAmLeader
 from typing import Dict
+from wal import WriteAheadLog, ACCEPT, LEARN, VIEW, RESET, DELIVER, EXECUTE_SLOT, CHECKPOINT
+from metrics import Metrics
+import codec
+
+_binary = codec.get_codec('binary')
+# the hash of the empty log
+EMPTY_HASH = bytes(hashlib.sha1().digest_size)
+# digests kept at the multiples of the digest interval, for the checks of a master behind this server
+DIGEST_HISTORY = 16
+
+
+def fold_hash(previous: bytes, proposal: Proposal):
+    # chain the operation delivered in the slot onto the hash of all the slots before it
+    content = str(proposal.slot).encode() + _binary.encode(proposal.operation)
+    return hashlib.sha1(previous + content).digest()
 
 
 def write_show_state(func):
     @wraps(func)
     def wrap(self, *args, **kwargs):
-        # todo write state
+        # the changes are written to the write ahead log by func itself
         result = func(self, *args, **kwargs)
-        # self.write_state()
         self.digest_state()
         return result
 
@@ -21,39 +38,114 @@ def write_show_state(func):
 
 
 class ServerState(object):
-    def __init__(self, uid, master_uid=0, skip_slots=None):
+    def __init__(self, uid, master_uid=0, skip_slots=None, shared=True,
+                 wal: WriteAheadLog = None, snapshot_interval=1000, retention=0, metrics: Metrics = None,
+                 digest_interval=0):
         self.view_modulo = 0
         self.uid = uid
+        # set after the state is restored from it
+        self.wal = None
 
         self.master_uid = master_uid
         self.is_master = False
         self.update_master_state()
 
-        self.manager = Manager()
-        self.lock = self.manager.Lock()
+        # shared state lives in a manager process so forked workers see the same log,
+        # otherwise the state is owned by a single process and kept in local dicts
+        self.shared = shared
+        if shared:
+            self.manager = Manager()
+            self.lock = self.manager.Lock()
+        else:
+            self.manager = None
+            self.lock = threading.Lock()
         self.lock_count = 0
+        # lock wait and hold times and execute batch sizes go to metrics unless it is None
+        self.metrics = metrics
+        self.locked_at = 0.0
         # {slot: Proposal}
-        self.delivered_proposals = self.manager.dict()
-        self.learned_proposal_buffer = self.manager.dict()
-        self.accepted_proposal_buffer = self.manager.dict()
+        self.delivered_proposals = self.new_dict()
+        self.learned_proposal_buffer = self.new_dict()
+        self.accepted_proposal_buffer = self.new_dict()
         # !!!! skip_slots is only used by master
         # !!!! should lost after view change
         assert self.is_master or skip_slots is None
         if skip_slots is None:
-            self.skip_slots = []
+            self.skip_slots = set()
         else:
-            self.skip_slots = skip_slots
+            self.skip_slots = set(skip_slots)
+        # every slot below execute_slot is delivered or skipped
+        # with shared state a forked worker may hold a stale (lower) copy, which is still correct
+        self.execute_slot = 0
+        # no slot below next_slot is empty, only used by the master to assign slots
+        self.next_slot = 0
+
+        # the delivered slots below checkpoint_slot are folded into checkpoint_hash and dropped,
+        # between retention and 2 * retention delivered slots are kept, 0 keeps the whole log
+        assert not shared or retention == 0
+        self.retention = retention
+        self.checkpoint_slot = 0
+        self.checkpoint_hash = EMPTY_HASH
+
+        # rolling digest of the delivered log, the hash chains every slot below the slot, shared by the forked
+        # workers so each slot is folded once, under the lock
+        self.digest = self.new_dict()
+        self.digest.update(slot=0, hash=EMPTY_HASH)
+        # {slot: digest} at the multiples of digest_interval, the last DIGEST_HISTORY of them
+        self.digest_interval = digest_interval
+        self.interval_digests = self.new_dict()
+        # {slot: digest} of the master at the slots this server has not delivered up to yet
+        self.pending_digest_checks = self.new_dict()
+
+        # a snapshot is taken every snapshot_interval delivered slots
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_slot = 0
+        if wal is not None:
+            # forked workers cannot share the log file
+            assert not shared
+            self.wal = wal
+            self.restore_state()
+
+    def new_dict(self):
+        if self.shared:
+            return self.manager.dict()
+        return {}
+
+    def local_copy(self, d):
+        # one round trip to the manager instead of one per lookup
+        return d.copy() if self.shared else d
 
     def acquire_lock(self):
         if self.lock_count == 0:
-            self.lock.acquire()
+            if self.metrics is None:
+                self.lock.acquire()
+            else:
+                started = time.perf_counter()
+                self.lock.acquire()
+                self.locked_at = time.perf_counter()
+                self.metrics.time('lock_wait', self.locked_at - started)
         self.lock_count += 1
 
     def release_lock(self):
         self.lock_count -= 1
         if self.lock_count == 0:
+            if self.metrics is not None:
+                self.metrics.time('lock_hold', time.perf_counter() - self.locked_at)
             self.lock.release()
 
+    def log(self, kind, value=None):
+        if self.wal is not None:
+            self.wal.append(kind, value)
+
+    def sync_log(self):
+        # called before anything depending on the state is sent
+        if self.wal is not None:
+            self.wal.sync()
+
+    def sync_log_left(self):
+        # seconds until the interval fsync policy is due, None if nothing waits for it
+        return None if self.wal is None else self.wal.sync_left()
+
     def update_master_state(self, master_uid=None, new_modulo=None):
         if master_uid is not None:
             self.master_uid = master_uid
@@ -63,47 +155,168 @@ class ServerState(object):
             self.is_master = True
         else:
             self.is_master = False
+        self.log(VIEW, IAmLeader(self.master_uid, self.view_modulo))
 
     @write_show_state
     def update_new_state(self, learned: Dict[int, Proposal]):
         self.acquire_lock()
         self.accepted_proposal_buffer.clear()
         self.learned_proposal_buffer.clear()
-        self.learned_proposal_buffer.update(learned)
+        self.log(RESET)
+        for slot, proposal in learned.items():
+            # delivered here already, maybe compacted
+            if slot >= self.execute_slot:
+                self.learned_proposal_buffer[slot] = proposal
+                self.log(LEARN, proposal)
+        # slots only accepted before the view change are empty again
+        self.next_slot = self.execute_slot
         result = self.execute()
         self.release_lock()
         return result
 
-    def get_all_learned_proposals(self) -> Dict[int, Proposal]:
+    def get_watermark(self):
+        # every slot below the watermark is delivered, even if execute_slot of this process is stale
+        self.acquire_lock()
+        delivered = self.local_copy(self.delivered_proposals)
+        slot = self.execute_slot
+        while slot in self.skip_slots or slot in delivered:
+            slot += 1
+        self.release_lock()
+        return slot
+
+    def get_learned_proposals_from(self, start_slot) -> Dict[int, Proposal]:
+        # the delivered and learned proposals of the slots from start_slot on, above the checkpoint
         self.acquire_lock()
         result = {}
-        result.update(self.delivered_proposals.copy())
-        result.update(self.learned_proposal_buffer.copy())
+        delivered = self.local_copy(self.delivered_proposals)
+        slot = max(start_slot, self.checkpoint_slot)
+        while slot < self.execute_slot or slot in self.skip_slots or slot in delivered:
+            if slot in delivered:
+                result[slot] = delivered[slot]
+            slot += 1
+        for slot, proposal in self.learned_proposal_buffer.items():
+            if slot >= start_slot:
+                result[slot] = proposal
         self.release_lock()
         return result
 
+    def delivered_watermark(self):
+        # like get_watermark, without the lock and the copy of the log, the stale execute slot of this process moves up
+        slot = self.execute_slot
+        while slot in self.skip_slots or slot in self.delivered_proposals:
+            slot += 1
+        self.execute_slot = slot
+        return slot
+
+    def read_delivered(self, start_slot, limit):
+        """
+        The proposals of up to limit consecutive delivered slots from start_slot on, from the checkpoint if compacted
+        :return: (start_slot, end_slot, {slot: Proposal}) every slot in [start_slot, end_slot) is delivered
+        """
+        # a delivered slot never changes, so no lock, with shared state a lookup per slot instead of a copy of the log
+        start_slot = max(start_slot, self.checkpoint_slot)
+        result = {}
+        slot = start_slot
+        while slot - start_slot < limit:
+            if slot not in self.skip_slots:
+                proposal = self.delivered_proposals.get(slot)
+                if proposal is None:
+                    break
+                result[slot] = proposal
+            slot += 1
+        return start_slot, slot, result
+
     def execute(self):
-        result = []
         self.acquire_lock()
-        k = -1
+        result = self.deliver_learned()
+        self.release_lock()
+        return result
+
+    def deliver_learned(self):
+        # the caller holds the lock or is the only process delivering
+        result = []
+        k = self.execute_slot
         while True:
-            k += 1
-            if k in self.skip_slots:
-                continue
-            if k in self.delivered_proposals:
+            if k in self.skip_slots or k in self.delivered_proposals:
+                k += 1
                 continue
-            if k in self.learned_proposal_buffer:
-                proposal = self.learned_proposal_buffer.pop(k)
-                self.delivered_proposals[k] = proposal
-                result.append(proposal)
-            else:
+            proposal = self.learned_proposal_buffer.get(k)
+            if proposal is None:
                 break
-        self.release_lock()
+            # delivered before it stops being learned, so the slot never looks empty to a proposer
+            self.delivered_proposals[k] = proposal
+            self.learned_proposal_buffer.pop(k)
+            result.append(proposal)
+            k += 1
+        self.execute_slot = k
+        if self.metrics is not None:
+            self.metrics.observe('execute_batch', len(result))
+        if self.retention and self.execute_slot - self.checkpoint_slot >= 2 * self.retention:
+            self.compact()
+        if self.wal is not None and self.execute_slot - self.snapshot_slot >= self.snapshot_interval:
+            self.write_snapshot()
         return result
 
+    def compact(self):
+        # fold the delivered slots older than the retention into the checkpoint
+        self.update_digest()
+        end = self.execute_slot - self.retention
+        for slot in range(self.checkpoint_slot, end):
+            proposal = self.delivered_proposals.pop(slot, None)
+            # skipped slots have no proposal
+            if proposal is not None:
+                self.checkpoint_hash = fold_hash(self.checkpoint_hash, proposal)
+        self.checkpoint_slot = end
+
+    def _set_checkpoint(self, slot, checkpoint_hash):
+        for compacted in range(self.checkpoint_slot, slot):
+            self.delivered_proposals.pop(compacted, None)
+            self.learned_proposal_buffer.pop(compacted, None)
+            self.accepted_proposal_buffer.pop(compacted, None)
+        self.checkpoint_slot = slot
+        self.checkpoint_hash = checkpoint_hash
+        self.execute_slot = max(self.execute_slot, slot)
+        self.next_slot = max(self.next_slot, slot)
+        if slot > self.digest['slot']:
+            self.digest.update(slot=slot, hash=checkpoint_hash)
+            # the checks of the skipped slots cannot be answered
+            for checked in [checked for checked in self.pending_digest_checks.keys() if checked < slot]:
+                self.pending_digest_checks.pop(checked)
+
+    def adopt_checkpoint(self, slot, checkpoint_hash):
+        """
+        Skip to the checkpoint of another server which is ahead of this execute slot,
+        the slots it compacted cannot be transferred any more.
+        """
+        self.acquire_lock()
+        if slot > self.execute_slot:
+            self._set_checkpoint(slot, checkpoint_hash)
+            self.log(CHECKPOINT, (slot, checkpoint_hash))
+        self.release_lock()
+
+    def is_learned(self, slot):
+        return slot < self.execute_slot or \
+               slot in self.learned_proposal_buffer or \
+               slot in self.delivered_proposals
+
+    def is_delivered(self, slot, operation_uid):
+        # whether the operation was delivered in the slot, a compacted slot is only known to be delivered
+        if slot < self.checkpoint_slot:
+            return True
+        proposal = self.delivered_proposals.get(slot)
+        return proposal is not None and operation_uid in proposal.operation.uids()
+
+    def get_accepted_proposal(self, slot):
+        return self.accepted_proposal_buffer.get(slot)
+
+    def get_delivered_proposal(self, slot):
+        # None once compacted
+        return self.delivered_proposals.get(slot)
+
     def is_empty_slot(self, slot):
         self.acquire_lock()
-        empty_slot = slot not in self.delivered_proposals and \
+        empty_slot = slot >= self.checkpoint_slot and \
+                     slot not in self.delivered_proposals and \
                      slot not in self.learned_proposal_buffer and \
                      slot not in self.accepted_proposal_buffer and \
                      slot not in self.skip_slots
@@ -127,6 +340,8 @@ class ServerState(object):
         slot = self.get_next_available_slot()
         proposal = Proposal(self.uid, self.view_modulo, client_address, slot, operation)
         self.accepted_proposal_buffer[slot] = proposal
+        self.log(ACCEPT, proposal)
+        self.next_slot = slot + 1
         self.release_lock()
         return proposal
 
@@ -134,6 +349,7 @@ class ServerState(object):
         self.acquire_lock()
         if self._can_accept_proposal(proposal):
             self.accepted_proposal_buffer[proposal.slot] = proposal
+            self.log(ACCEPT, proposal)
             accepted = True
         else:
             accepted = False
@@ -145,33 +361,158 @@ class ServerState(object):
         self.acquire_lock()
         self.accepted_proposal_buffer.pop(proposal.slot, 'None')
         self.learned_proposal_buffer[proposal.slot] = proposal
+        self.log(LEARN, proposal)
+        result = self.execute()
+        self.release_lock()
+        return result
+
+    @write_show_state
+    def apply_learned(self, proposals):
+        """
+        Learn the decided proposals and deliver them without the lock, only called by the one applier of the state
+        """
+        for proposal in proposals:
+            # a slot may be queued twice, by repeated commits, before it is delivered
+            if proposal.slot >= self.execute_slot:
+                # learned before it stops being accepted, so the slot never looks empty to a proposer
+                self.learned_proposal_buffer[proposal.slot] = proposal
+                self.log(LEARN, proposal)
+            self.accepted_proposal_buffer.pop(proposal.slot, None)
+        return self.deliver_learned()
+
+    def get_committed(self, master_uid, view_modulo, commit_slot, slots):
+        """
+        The accepted proposals of the master in the given slots and in every slot below commit_slot.
+        Slots whose proposal was never accepted here are left for the next view change.
+        """
+        committed = set(slots)
+        committed.update(slot for slot in self.accepted_proposal_buffer.keys() if slot < commit_slot)
+        result = []
+        for slot in committed:
+            proposal = self.accepted_proposal_buffer.get(slot)
+            # a proposal of an older master in the same slot was not decided by this commit
+            if proposal is not None and proposal.master_uid == master_uid and proposal.view_modulo == view_modulo:
+                result.append(proposal)
+        return result
+
+    @write_show_state
+    def learn_committed(self, master_uid, view_modulo, commit_slot, slots):
+        self.acquire_lock()
+        for proposal in self.get_committed(master_uid, view_modulo, commit_slot, slots):
+            self.accepted_proposal_buffer.pop(proposal.slot)
+            self.learned_proposal_buffer[proposal.slot] = proposal
+            self.log(LEARN, proposal)
         result = self.execute()
         self.release_lock()
         return result
 
     def get_next_available_slot(self):
-        i = 0
+        # the cursor only moves forward, so the scan is amortized O(1) per proposal
+        i = max(self.next_slot, self.execute_slot)
         while True:
             if self.is_empty_slot(i):
                 break
             i += 1
         return i
 
-    # def write_state(self):
-    #     filename = 'state_%s.json' % self.uid
-    #     with open(filename, 'w') as f:
-    #         f.write(jsonpickle.encode(self))
+    def write_snapshot(self):
+        view = (VIEW, IAmLeader(self.master_uid, self.view_modulo))
+        snapshot = [view, (CHECKPOINT, (self.checkpoint_slot, self.checkpoint_hash)),
+                    (EXECUTE_SLOT, self.execute_slot)]
+        snapshot.extend((DELIVER, proposal) for proposal in self.delivered_proposals.values())
+        # the log keeps what the snapshot does not cover
+        log = [view]
+        log.extend((ACCEPT, proposal) for proposal in self.accepted_proposal_buffer.values())
+        log.extend((LEARN, proposal) for proposal in self.learned_proposal_buffer.values())
+        self.wal.write_snapshot(snapshot, log)
+        self.snapshot_slot = self.execute_slot
+
+    def restore_state(self):
+        # replay the snapshot and then the log, nothing is logged while replaying
+        wal, self.wal = self.wal, None
+        for kind, value in itertools.chain(wal.read_snapshot(), wal.read()):
+            if kind == VIEW:
+                self.update_master_state(value.uid, value.view_modulo)
+            elif kind == CHECKPOINT:
+                self._set_checkpoint(*value)
+            elif kind == EXECUTE_SLOT:
+                self.execute_slot = value
+                self.snapshot_slot = value
+            elif kind == DELIVER:
+                self.delivered_proposals[value.slot] = value
+            elif kind == ACCEPT:
+                self.accepted_proposal_buffer[value.slot] = value
+            elif kind == LEARN:
+                self.accepted_proposal_buffer.pop(value.slot, None)
+                if value.slot not in self.delivered_proposals:
+                    self.learned_proposal_buffer[value.slot] = value
+            elif kind == RESET:
+                self.accepted_proposal_buffer.clear()
+                self.learned_proposal_buffer.clear()
+        # the snapshot restores the checkpoint but not the digest of the slots above it
+        self.digest.update(slot=self.checkpoint_slot, hash=self.checkpoint_hash)
+        self.execute()
+        self.next_slot = self.execute_slot
+        self.wal = wal
+
+    def update_digest(self):
+        # fold the slots delivered since the last call, with shared state they may be delivered by other processes
+        self.acquire_lock()
+        slot, digest = self.digest['slot'], self.digest['hash']
+        start = slot
+        while True:
+            proposal = None if slot in self.skip_slots else self.delivered_proposals.get(slot)
+            if proposal is None and slot not in self.skip_slots:
+                break
+            if proposal is not None:
+                digest = fold_hash(digest, proposal)
+            slot += 1
+            if self.digest_interval and slot % self.digest_interval == 0:
+                self.interval_digests[slot] = digest
+                self.interval_digests.pop(slot - DIGEST_HISTORY * self.digest_interval, None)
+                checked = self.pending_digest_checks.pop(slot, None)
+                if checked is not None:
+                    self._compare_digest(slot, digest, checked)
+        if slot != start:
+            self.digest.update(slot=slot, hash=digest)
+        self.release_lock()
+
+    def get_digest(self):
+        """
+        :return: (slot, digest) the hash of every operation delivered below the slot
+        """
+        self.update_digest()
+        return self.digest['slot'], self.digest['hash']
+
+    def get_interval_digest(self):
+        """
+        :return: (slot, digest) at the latest multiple of the digest interval this server delivered up to,
+            (0, EMPTY_HASH) before the first one
+        """
+        slot, _ = self.get_digest()
+        slot -= slot % self.digest_interval
+        return slot, self.interval_digests.get(slot, EMPTY_HASH)
+
+    def _compare_digest(self, slot, digest, checked):
+        if digest != checked:
+            sys.stderr.write("Server-%s: Divergence below slot %s: sha1 %s, master sha1 %s\n" % (
+                self.uid, slot, digest.hex(), checked.hex()))
+
+    def check_digest(self, slot, digest):
+        """
+        Compare with the digest of the master at a multiple of the digest interval, later if this server has not
+        delivered up to the slot yet. A slot compacted into a checkpoint or older than the kept digests is skipped.
+        """
+        self.update_digest()
+        self.acquire_lock()
+        own = self.interval_digests.get(slot)
+        if own is not None:
+            self._compare_digest(slot, own, digest)
+        elif slot > self.digest['slot']:
+            self.pending_digest_checks[slot] = digest
+        self.release_lock()
 
     def digest_state(self):
-        print("Server-%s: Sanity Check: %s" % (self.uid, self.get_all_learned_proposals()))
-
-        # print('Hash Sanity Check-%s: %s' % (
-        #     self.uid, hashlib.sha1(
-        #           jsonpickle.encode(self.get_all_learned_operations()).encode()
-        #     ).hexdigest()
-        # ))
-
-    # @classmethod
-    # def restore_state(cls, uid):
-    #     filename = 'state_%s.json' % uid
-    #     return jsonpickle.decode(open(filename).read())
+        slot, digest = self.get_digest()
+        print("Server-%s: Sanity Check: %s slots, sha1 %s" % (self.uid, slot, digest.hex()))
+
@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+from typing import Dict
+from message import Proposal
+
+
+class SessionTable(object):
+    """
+    The slot of every operation the master proposed, keyed by Operation.uid, so a
+    retried request is answered instead of being decided again in another slot.
+    The least recently used entries are evicted beyond capacity operations.
+    """
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        # {operation uid: (slot, proposed at)}, the slot is None while the operation waits in a batch or the window
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, uid):
+        entry = self.entries.get(uid)
+        if entry is not None:
+            self.entries.move_to_end(uid)
+        return entry
+
+    def add(self, uid, slot=None):
+        self.entries[uid] = (slot, time.monotonic())
+        self.entries.move_to_end(uid)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def assign(self, proposal: Proposal):
+        for uid in proposal.operation.uids():
+            self.add(uid, proposal.slot)
+
+    def rebuild(self, learned: Dict[int, Proposal]):
+        # only from the decided log in slot order, so every master of the same log has the same table,
+        # the slots are proposed again by the new master, so a retry waits for its timeout as well
+        self.entries.clear()
+        for slot in sorted(learned):
+            for uid in learned[slot].operation.uids():
+                self.add(uid, slot)
@@ -0,0 +1,60 @@
+import argparse
+import json
+import socket
+import time
+from config import ServerClusterConfig
+from message import StatsRequest, StatsReply, ProfileControl
+from transport import DatagramChannel
+import codec
+
+
+def query_stats(config: ServerClusterConfig, uids, timeout=1.0, group=0):
+    """
+    :return: {uid: metrics} of the servers which replied within timeout, empty for a server without metrics
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("", 0))
+    channel = DatagramChannel(sock, timeout)
+    request = codec.get_codec(config.codec).encode(StatsRequest(), group)
+    for uid in uids:
+        channel.sendto(request, config.get_address(uid, group))
+    result = {}
+    deadline = time.monotonic() + timeout
+    try:
+        while len(result) < len(uids) and time.monotonic() < deadline:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            raw, _ = channel.recvfrom()
+            reply = codec.decode(raw)
+            if isinstance(reply, StatsReply):
+                result[reply.uid] = json.loads(reply.stats) if reply.stats else {}
+    except socket.timeout:
+        pass
+    finally:
+        sock.close()
+    return result
+
+
+def control_profiling(config: ServerClusterConfig, uids, enable, group=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    request = codec.get_codec(config.codec).encode(ProfileControl(enable), group)
+    for uid in uids:
+        sock.sendto(request, config.get_address(uid, group))
+    sock.close()
+
+
+parser = argparse.ArgumentParser(description='Query the metrics of the servers')
+parser.add_argument('-c', default='config.json', type=str, help='the config filename')
+parser.add_argument('-uid', default=None, type=int, help='the server to query, all of them if not set')
+parser.add_argument('-timeout', default=1.0, type=float, help='seconds to wait for the replies')
+parser.add_argument('-group', default=0, type=int, help='the consensus group of the servers')
+parser.add_argument('-profile', default=None, choices=['start', 'stop'], help='start or stop profiling instead')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    config = ServerClusterConfig.read_config(args.c)
+    uids = list(range(len(config.servers_config))) if args.uid is None else [args.uid]
+    if args.profile is not None:
+        control_profiling(config, uids, args.profile == 'start', args.group)
+        exit()
+    stats = query_stats(config, uids, args.timeout, args.group)
+    print(json.dumps({'server-%s' % uid: stats.get(uid) for uid in uids}, indent=2))
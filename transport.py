@@ -0,0 +1,129 @@
+import os
+import random
+import struct
+import time
+from collections import OrderedDict
+
+# the largest datagram sent or received, bigger messages are split into fragments
+MAX_PACKAGE_LENGTH = 4096
+# payload of a fragment, small enough to pass an ethernet mtu without ip fragmentation
+FRAGMENT_PAYLOAD = 1400
+# the largest message reassembled, bounds the memory of a partial message
+MAX_MESSAGE_LENGTH = 1 << 20
+# neither a json document nor a binary codec message starts with it
+FRAGMENT_MAGIC = 0xFB
+# (magic, message id, fragment index, fragment count)
+_FRAGMENT = struct.Struct('!BIHH')
+
+
+class _Partial(object):
+    __slots__ = ('deadline', 'count', 'missing', 'received', 'length', 'buffer')
+
+    def __init__(self, deadline, count):
+        self.deadline = deadline
+        self.count = count
+        self.missing = count
+        self.received = bytearray(count)
+        self.length = min(count * FRAGMENT_PAYLOAD, MAX_MESSAGE_LENGTH)
+        self.buffer = bytearray(self.length)
+
+
+class DatagramChannel(object):
+    """
+    Sends and receives whole messages over a udp socket.
+    A message longer than MAX_PACKAGE_LENGTH is split into fragments, each one
+    prefixed with the id of the message and its index, and the receiver copies them
+    into the buffer of the message until every fragment arrived.
+    At most max_pending messages are reassembled at once, the oldest is dropped to
+    make room, and a message still incomplete after timeout seconds is dropped as well.
+    Smaller messages are sent as they are.
+    """
+
+    def __init__(self, sock, timeout, max_pending=32):
+        self.socket = sock
+        self.timeout = timeout
+        self.max_pending = max_pending
+        # {(address, message id): _Partial} in arrival order, so the oldest is evicted first
+        self.pending = OrderedDict()
+        self.evicted = 0
+        self.pid = None
+        self.next_id = 0
+        # every datagram is received into the same buffer
+        self.buffer = bytearray(MAX_PACKAGE_LENGTH)
+        self.view = memoryview(self.buffer)
+
+    def message_id(self):
+        if self.pid != os.getpid():
+            # forked workers send from the same address, they must not reuse the ids of each other
+            self.pid = os.getpid()
+            self.next_id = random.getrandbits(32)
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        return self.next_id
+
+    def fragment(self, data: bytes):
+        if len(data) <= MAX_PACKAGE_LENGTH:
+            return [data]
+        assert len(data) <= MAX_MESSAGE_LENGTH, "message of %s bytes is too long" % len(data)
+        message_id = self.message_id()
+        view = memoryview(data)
+        count = (len(data) + FRAGMENT_PAYLOAD - 1) // FRAGMENT_PAYLOAD
+        return [_FRAGMENT.pack(FRAGMENT_MAGIC, message_id, i, count) +
+                view[i * FRAGMENT_PAYLOAD:(i + 1) * FRAGMENT_PAYLOAD] for i in range(count)]
+
+    def evict(self, now):
+        # the deadlines share one timeout, so they expire in arrival order
+        while self.pending:
+            key, partial = next(iter(self.pending.items()))
+            if partial.deadline > now:
+                return
+            del self.pending[key]
+            self.evicted += 1
+
+    def reassemble(self, datagram, address):
+        """
+        :return: the message completed by the datagram, None while some fragments are missing,
+        a datagram which is not a fragment is returned as it is, decode it before the next one is received
+        """
+        if len(datagram) < _FRAGMENT.size or datagram[0] != FRAGMENT_MAGIC:
+            return datagram
+        _, message_id, index, count = _FRAGMENT.unpack_from(datagram)
+        payload = datagram[_FRAGMENT.size:]
+        # the same bound as fragment, the last fragment may be short
+        if index >= count or (count - 1) * FRAGMENT_PAYLOAD >= MAX_MESSAGE_LENGTH or \
+                (index == count - 1 and index * FRAGMENT_PAYLOAD + len(payload) > MAX_MESSAGE_LENGTH) or \
+                len(payload) > FRAGMENT_PAYLOAD or (index < count - 1 and len(payload) != FRAGMENT_PAYLOAD):
+            # not a fragment of ours
+            return None
+        now = time.monotonic()
+        self.evict(now)
+        key = (address, message_id)
+        partial = self.pending.get(key)
+        if partial is None:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.evicted += 1
+            partial = _Partial(now + self.timeout, count)
+            self.pending[key] = partial
+        if partial.count != count or partial.received[index]:
+            return None
+        start = index * FRAGMENT_PAYLOAD
+        partial.buffer[start:start + len(payload)] = payload
+        partial.received[index] = 1
+        partial.missing -= 1
+        if index == count - 1:
+            partial.length = start + len(payload)
+        if partial.missing:
+            return None
+        del self.pending[key]
+        return bytes(partial.buffer[:partial.length])
+
+    def sendto(self, data: bytes, address):
+        for datagram in self.fragment(data):
+            self.socket.sendto(datagram, address)
+
+    def recvfrom(self):
+        while True:
+            size, address = self.socket.recvfrom_into(self.buffer)
+            message = self.reassemble(self.view[:size], address)
+            if message is not None:
+                return message, address
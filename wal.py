@@ -0,0 +1,143 @@
+import os
+import struct
+import time
+import zlib
+import codec
+
+# record kinds
+ACCEPT = 1
+LEARN = 2
+VIEW = 3
+# the accepted and learned buffers were replaced by a view change
+RESET = 4
+DELIVER = 5
+EXECUTE_SLOT = 6
+# (slot, hash) of the compacted prefix of the log
+CHECKPOINT = 7
+
+FSYNC_POLICIES = ('always', 'group', 'interval')
+
+# (payload length, crc32 of kind and payload, kind)
+_RECORD = struct.Struct('!IIB')
+_SLOT = struct.Struct('!q')
+_CHECKPOINT = struct.Struct('!q20s')
+_binary = codec.get_codec('binary')
+
+
+def _encode_payload(kind, value):
+    if value is None:
+        return b''
+    if kind == EXECUTE_SLOT:
+        return _SLOT.pack(value)
+    if kind == CHECKPOINT:
+        return _CHECKPOINT.pack(*value)
+    return _binary.encode(value)
+
+
+def _decode_payload(kind, payload):
+    if not payload:
+        return None
+    if kind == EXECUTE_SLOT:
+        return _SLOT.unpack(payload)[0]
+    if kind == CHECKPOINT:
+        return _CHECKPOINT.unpack(payload)
+    return codec.decode(payload)
+
+
+def _pack_record(kind, value):
+    payload = _encode_payload(kind, value)
+    crc = zlib.crc32(payload, kind)
+    return _RECORD.pack(len(payload), crc, kind) + payload
+
+
+def _read_records(path):
+    """
+    Yield the (kind, value) records of a file, stops at the first torn or corrupted record
+    which is what a crash in the middle of a write leaves behind.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + _RECORD.size <= len(data):
+        length, crc, kind = _RECORD.unpack_from(data, offset)
+        payload = data[offset + _RECORD.size:offset + _RECORD.size + length]
+        if len(payload) != length or zlib.crc32(payload, kind) != crc:
+            return
+        offset += _RECORD.size + length
+        yield kind, _decode_payload(kind, payload)
+
+
+def _write_atomic(path, records):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(_pack_record(kind, value) for kind, value in records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class WriteAheadLog(object):
+    """
+    Append only log of the state changes of a ServerState plus its latest snapshot.
+    Records are buffered until sync, which has to be called before anything depending
+    on them leaves the server, so one fsync covers every change since the last message (group commit).
+        always: fsync every record as it is appended
+        group: fsync on sync
+        interval: fsync on sync or append once the last fsync is older than interval seconds, the server
+            calls sync once sync_left runs out, so no record waits longer than that for its fsync
+    """
+
+    def __init__(self, path, policy='group', interval=0.05):
+        assert policy in FSYNC_POLICIES
+        self.path = path + '.wal'
+        self.snapshot_path = path + '.snapshot'
+        self.policy = policy
+        self.interval = interval
+        self.file = open(self.path, 'ab')
+        self.dirty = False
+        self.synced_at = time.monotonic()
+
+    def append(self, kind, value=None):
+        self.file.write(_pack_record(kind, value))
+        self.dirty = True
+        if self.policy != 'group':
+            self.sync()
+
+    def sync(self):
+        if not self.dirty:
+            return
+        self.file.flush()
+        if self.policy == 'interval' and time.monotonic() - self.synced_at < self.interval:
+            # the os has the records, they reach the disk with a later fsync
+            return
+        os.fsync(self.file.fileno())
+        self.dirty = False
+        self.synced_at = time.monotonic()
+
+    def sync_left(self):
+        """
+        :return: seconds until the records not fsynced yet are due under the interval policy, None if there are none
+        """
+        if self.policy != 'interval' or not self.dirty:
+            return None
+        return max(self.synced_at + self.interval - time.monotonic(), 0.0)
+
+    def read(self):
+        return _read_records(self.path)
+
+    def read_snapshot(self):
+        return _read_records(self.snapshot_path)
+
+    def write_snapshot(self, snapshot_records, log_records):
+        """
+        Replace the snapshot, then truncate the log to the records not covered by it.
+        A crash between the two only leaves records the snapshot already covers.
+        """
+        _write_atomic(self.snapshot_path, snapshot_records)
+        self.file.close()
+        _write_atomic(self.path, log_records)
+        self.file = open(self.path, 'ab')
+        self.dirty = False
+        self.synced_at = time.monotonic()